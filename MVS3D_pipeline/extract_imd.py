@@ -3,56 +3,136 @@
 # and Centralizing Them for Satellite Image Metadata Parsing.
 #
 # Purpose:
-#   - Extract .imd metadata files from the original MVS3D dataset
+#   - Harvest .imd metadata files from the original MVS3D .tar archives
 #   - Prepare for retrieving imaging time, intersection angle, etc.
 #
+# The archives are NOT extracted: tar members are iterated and only the
+# small .imd entries are read (imagery members are skipped), archives are
+# processed in parallel, and archives already harvested (same size/mtime,
+# recorded in harvested_archives.json) are skipped on later runs.
+# The output folder is then indexed into the IMD metadata store.
+#
 # Author: Chen Liu, Wuhan University
 # Contact: sweetdegree@gmail.com
 # ---------------------------------------------------------------
 
 import os
+import sys
+import json
 import tarfile
-import shutil
-
-# Set the root directory where your data is located
-root_dir = r"H:\IARPA_MVS_DATASET\WV3\PAN"
-
-# Step 1: Extract all .tar files in the root_dir and its subdirectories
-for dirpath, dirnames, filenames in os.walk(root_dir):
-    for fname in filenames:
-        if fname.lower().endswith('.tar'):
-            tar_path = os.path.join(dirpath, fname)
-            # Extract to a folder with the same name as the .tar file (without extension)
-            extract_dir = os.path.splitext(tar_path)[0]
-            if not os.path.exists(extract_dir):
-                os.makedirs(extract_dir)
-            print(f"Extracting: {tar_path} -> {extract_dir}")
-            with tarfile.open(tar_path) as tar:
-                tar.extractall(path=extract_dir)
-
-# Step 2: Search for all IMD files after extraction
-imd_list = []
-
-for dirpath, dirnames, filenames in os.walk(root_dir):
-    for fname in filenames:
-        if fname.lower().endswith('.imd'):
-            imd_list.append(os.path.join(dirpath, fname))
-
-print(f"Found {len(imd_list)} IMD files in total.")
-for path in imd_list:
-    print(path)
-
-# Step 3: Copy all IMD files to a single output folder, renaming to avoid duplicate names
-root_dir = r"H:\IARPA_MVS_DATASET\WV3\PAN"
-out_dir = r"H:\IMD_ALL"
-os.makedirs(out_dir, exist_ok=True)
-
-for dirpath, dirnames, filenames in os.walk(root_dir):
-    for fname in filenames:
-        if fname.lower().endswith('.imd'):
-            in_path = os.path.join(dirpath, fname)
-            # Rename using the parent folder name to avoid duplication
-            new_name = f"{os.path.basename(dirpath)}_{fname}"
-            out_path = os.path.join(out_dir, new_name)
-            shutil.copy2(in_path, out_path)
-            print(f"Copied {in_path} -> {out_path}")
+import posixpath
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imd_store import IMDStore, default_db_path
+
+MANIFEST_NAME = "harvested_archives.json"
+
+
+def find_tar_files(root_dir):
+    """All .tar files under root_dir (recursively)"""
+    tar_list = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        for fname in filenames:
+            if fname.lower().endswith('.tar'):
+                tar_list.append(os.path.join(dirpath, fname))
+    return sorted(tar_list)
+
+
+def imd_output_name(tar_path, member_name):
+    """
+    Same naming as the old extract-then-copy workflow: <parent folder>_<file name>,
+    where a top-level member's parent folder is the extraction folder (tar name without extension).
+    """
+    parent = posixpath.dirname(member_name.replace('\\', '/'))
+    parent_name = posixpath.basename(parent) if parent else os.path.splitext(os.path.basename(tar_path))[0]
+    return f"{parent_name}_{posixpath.basename(member_name)}"
+
+
+def harvest_imds_from_tar(tar_path, out_dir):
+    """
+    Copy every .imd member of one archive into out_dir without extracting the imagery.
+    Seekable tar reading only touches member headers and the .imd payloads.
+    Returns the list of written file names.
+    """
+    written = []
+    with tarfile.open(tar_path, 'r:*') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.lower().endswith('.imd'):
+                continue
+            f = tar.extractfile(member)
+            if f is None:
+                continue
+            new_name = imd_output_name(tar_path, member.name)
+            with open(os.path.join(out_dir, new_name), 'wb') as out:
+                out.write(f.read())
+            written.append(new_name)
+    return written
+
+
+def load_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(out_dir, manifest):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def harvest_all_imds(root_dir, out_dir, max_workers=4, force=False, update_store=True, db_path=None):
+    """
+    Harvest IMDs from all archives under root_dir into out_dir, in parallel.
+    Archives whose size and mtime match the manifest entry are skipped unless force=True.
+    The IMD store is refreshed at db_path (default out_dir/imd_store.sqlite).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {} if force else load_manifest(out_dir)
+
+    todo = []
+    for tar_path in find_tar_files(root_dir):
+        st = os.stat(tar_path)
+        done = manifest.get(tar_path)
+        if done and done["size"] == st.st_size and done["mtime"] == st.st_mtime:
+            continue
+        todo.append((tar_path, st.st_size, st.st_mtime))
+    print(f"Found {len(todo)} archives to harvest ({len(manifest)} already in manifest).")
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(harvest_imds_from_tar, tar_path, out_dir): (tar_path, size, mtime)
+                   for tar_path, size, mtime in todo}
+        for fut in as_completed(futures):
+            tar_path, size, mtime = futures[fut]
+            try:
+                written = fut.result()
+            except Exception as e:
+                print(f"❌ Failed: {tar_path} ({e})")
+                failed.append(tar_path)
+                continue
+            manifest[tar_path] = {"size": size, "mtime": mtime, "imds": written}
+            # 每完成一个归档就写一次清单，中断后重跑可以跳过已完成的归档
+            save_manifest(out_dir, manifest)
+            print(f"Harvested {len(written)} IMD from {tar_path}")
+
+    n_imd = sum(len(v["imds"]) for v in manifest.values())
+    print(f"Total {n_imd} IMD files from {len(manifest)} archives in {out_dir} ({len(failed)} failed).")
+
+    if update_store:
+        with IMDStore(db_path or default_db_path(out_dir)) as store:
+            stats = store.refresh(out_dir)
+        print(f"IMD store updated: parsed {stats['parsed']}, unchanged {stats['unchanged']}, removed {stats['removed']}")
+    return manifest, failed
+
+
+if __name__ == "__main__":
+    # Set the root directory where your data is located
+    root_dir = r"H:\IARPA_MVS_DATASET\WV3\PAN"
+    out_dir = r"H:\IMD_ALL"
+    harvest_all_imds(root_dir, out_dir, max_workers=8)
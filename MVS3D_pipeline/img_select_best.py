@@ -8,13 +8,31 @@
 # Date: 2025-7-19
 # ------------------------------------------------------------------------------
 
+import io
 import os
 import re
+import sys
+import traceback
 from glob import glob
 from datetime import datetime
 from itertools import combinations
+from functools import partial
+from contextlib import redirect_stdout
 import json
 import math
+import heapq
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imd_store import load_imd_records, refresh_imd_store
+from folder_runner import run_folders, print_folder_summary
+from geo_utils import compute_pair_matrices
+
+# Default number of partial groups kept per step by the beam-search selector
+DEFAULT_BEAM_WIDTH = 64
+
+# uid -> IMD record index of the current process (set by init_imd_index, one per pool worker)
+_IMD_DICT = None
 
 def get_unique_id(filename):
     """Extract unique ID from image or IMD filename"""
@@ -65,38 +83,52 @@ def compute_convergence_angle(az1, az2, el1, el2):
     cos_d = math.sin(el1) * math.sin(el2) + math.cos(el1) * math.cos(el2) * math.cos(az1 - az2)
     return math.degrees(math.acos(min(max(cos_d, -1.0), 1.0)))
 
-def save_selected_image_paths(image_infos, output_path):
-    """Save selected image file names to a JSON file"""
+def save_selected_image_paths(image_infos, output_path, view_overlap=None):
+    """Save selected image file names (and optionally the per-view footprint overlap) to a JSON file"""
     json_data = {
         "selected_images": [os.path.basename(info["image_path"]) for info in image_infos]
     }
+    if view_overlap is not None:
+        json_data["view_overlap"] = view_overlap
     with open(output_path, "w") as f:
         json.dump(json_data, f, indent=4)
     print(f"Saved successfully: {output_path}")
 
-def collect_images_in_one_folder(image_folder, metadata_root):
+def build_imd_index(metadata_root, imd_records=None, db_path=None):
+    """
+    Map unique image ID -> IMD record for the *.IMD files directly under metadata_root,
+    loaded from the persistent metadata store (see imd_store.py; db_path defaults to
+    metadata_root/imd_store.sqlite).
+    """
+    if imd_records is None:
+        imd_records = load_imd_records(metadata_root, db_path=db_path)
+    imd_dict = {}
+    for (region, image_id), rec in sorted(imd_records.items()):
+        if region:
+            continue
+        uid = get_unique_id(rec["path"])
+        if uid:
+            imd_dict[uid] = rec
+    return imd_dict
+
+def collect_images_in_one_folder(image_folder, metadata_root, imd_dict=None, imd_db_path=None):
     """Read image and metadata pairs from a folder"""
     image_infos = []
     tif_files = sorted(glob(os.path.join(image_folder, '*.tif')))
-    imd_dict = {}
-
-    for imd_path in glob(os.path.join(metadata_root, "*.IMD")):
-        uid = get_unique_id(imd_path)
-        if uid:
-            imd_dict[uid] = imd_path
+    if imd_dict is None:
+        imd_dict = build_imd_index(metadata_root, db_path=imd_db_path)
 
     for tif_path in tif_files:
         uid = get_unique_id(tif_path)
         if not uid or uid not in imd_dict:
             print(f"⚠️ IMD not found for: {tif_path}")
             continue
-        imd_path = imd_dict[uid]
-        dt = extract_imd_datetime(imd_path)
-        az, el = extract_imd_angles(imd_path)
+        rec = imd_dict[uid]
+        dt, az, el = rec["datetime"], rec["sat_az"], rec["sat_el"]
         if dt is not None and az is not None and el is not None:
             image_infos.append({
                 "image_path": tif_path,
-                "imd_path": imd_path,
+                "imd_path": rec["path"],
                 "datetime": dt,
                 "unique_id": uid,
                 "az": az,
@@ -131,44 +163,184 @@ def group_score(group, target_angle=20.0, target_time_span=3.0):
     score = angle_penalty + time_penalty
     return score, time_span, angles
 
-def select_best_k_images(image_infos, k=3):
-    """Select the best k images based on score"""
-    if len(image_infos) <= k:
-        return image_infos, 0.0, [], 0.0
+def select_top_n_groups(image_infos, k=3, n=1, target_angle=20.0, target_time_span=3.0):
+    """
+    Exact branch-and-bound search for the n lowest-scoring k-image groups.
+
+    Groups are extended in index order (same order as combinations). A partial group's
+    lower bound is its pair-angle penalty so far plus max(0, span_so_far - target_time_span);
+    adding images can only increase both terms, so subtrees whose bound exceeds the
+    current n-th best score are skipped. Only a size-n heap is kept (O(n) memory).
+    On equal scores the earlier group wins, as with the exhaustive scan.
+
+    Returns:
+        top (list): [(score, group_indices, time_span, angles), ...] sorted by score.
+        stats (dict): number of fully scored groups ("leaves") and pruned branches.
+    """
+    angles_mat, _, times_seconds = compute_pair_matrices(image_infos)
+    angles_mat = angles_mat.tolist()
+    times = times_seconds.tolist()
+    heap = []  # (-score, -seq, group, time_span, angles); heap[0] is the current n-th best
+    stats = {"leaves": 0, "pruned": 0}
+    seq = [0]
+
+    def worst_score():
+        return -heap[0][0] if len(heap) >= n else float('inf')
+
+    def extend(group, start, penalty_sum, t_min, t_max):
+        if len(group) == k:
+            # Re-sum in group_score's pair order so scores match the per-group scorer exactly
+            angles = [angles_mat[group[a]][group[b]] for a in range(k) for b in range(a + 1, k)]
+            time_span = (t_max - t_min) / 86400.0
+            score = sum(abs(a - target_angle) for a in angles) + abs(time_span - target_time_span)
+            stats["leaves"] += 1
+            seq[0] += 1
+            item = (-score, -seq[0], tuple(group), time_span, angles)
+            if len(heap) < n:
+                heapq.heappush(heap, item)
+            elif score < worst_score():
+                heapq.heapreplace(heap, item)
+            return
+
+        for i in range(start, len(image_infos) - (k - len(group)) + 1):
+            new_penalty = penalty_sum + sum(abs(angles_mat[g][i] - target_angle) for g in group)
+            new_min, new_max = min(t_min, times[i]), max(t_max, times[i])
+            lower_bound = new_penalty + max(0.0, (new_max - new_min) / 86400.0 - target_time_span)
+            # small slack for floating-point summation order
+            if lower_bound > worst_score() + 1e-9:
+                stats["pruned"] += 1
+                continue
+            extend(group + [i], i + 1, new_penalty, new_min, new_max)
+
+    if 0 < k <= len(image_infos) and n > 0:
+        extend([], 0, 0.0, float('inf'), float('-inf'))
+
+    top = [(-neg_score, group, time_span, angles)
+           for neg_score, _, group, time_span, angles in sorted(heap, key=lambda x: (-x[0], -x[1]))]
+    return top, stats
+
+def select_top_n_groups_beam(image_infos, k=3, n=1, target_angle=20.0, target_time_span=3.0,
+                             beam_width=DEFAULT_BEAM_WIDTH):
+    """
+    Approximate beam-search selector for large view sets (60-100 views, k up to 8).
+
+    Starts from the beam_width best image pairs and grows each partial group by one view
+    per step, keeping the beam_width partial groups with the lowest branch-and-bound
+    lower bound (pair-angle penalty + max(0, span - target_time_span)). Each step costs
+    O(beam_width * k * n_views); the result is not guaranteed to be optimal.
+
+    Returns the same (top, stats) structure as select_top_n_groups. For k == 1 there is
+    nothing to approximate and the exact search is used.
+    """
+    if k < 2:
+        return select_top_n_groups(image_infos, k=k, n=n, target_angle=target_angle,
+                                   target_time_span=target_time_span)
+    angle_mat, _, times_seconds = compute_pair_matrices(image_infos)
+    n_views = len(image_infos)
+    stats = {"expanded": 0}
+    if k > n_views or n <= 0:
+        return [], stats
+
+    pen_mat = np.abs(angle_mat - target_angle)
+    ii, jj = np.triu_indices(n_views, 1)
+    spans = np.abs(times_seconds[ii] - times_seconds[jj]) / 86400.0
+    pair_bounds = pen_mat[ii, jj] + np.maximum(0.0, spans - target_time_span)
+    order = np.lexsort((jj, ii, pair_bounds))[:beam_width]
+    # Beam entries: (bound, sorted index tuple, angle penalty sum, t_min, t_max)
+    beam = [(float(pair_bounds[o]), (int(ii[o]), int(jj[o])), float(pen_mat[ii[o], jj[o]]),
+             float(min(times_seconds[ii[o]], times_seconds[jj[o]])),
+             float(max(times_seconds[ii[o]], times_seconds[jj[o]]))) for o in order]
+
+    for _ in range(k - 2):
+        children = {}
+        for _, group, penalty_sum, t_min, t_max in beam:
+            idx = list(group)
+            mask = np.ones(n_views, dtype=bool)
+            mask[idx] = False
+            cand = np.nonzero(mask)[0]
+            new_pen = penalty_sum + pen_mat[np.ix_(idx, cand)].sum(axis=0)
+            new_min = np.minimum(t_min, times_seconds[cand])
+            new_max = np.maximum(t_max, times_seconds[cand])
+            bounds = new_pen + np.maximum(0.0, (new_max - new_min) / 86400.0 - target_time_span)
+            stats["expanded"] += int(cand.size)
+            for c, b, pen, lo, hi in zip(cand.tolist(), bounds.tolist(), new_pen.tolist(),
+                                         new_min.tolist(), new_max.tolist()):
+                key = tuple(sorted(group + (c,)))
+                if key not in children:  # the same group can be reached from several parents
+                    children[key] = (b, key, pen, lo, hi)
+        beam = heapq.nsmallest(beam_width, children.values(), key=lambda x: (x[0], x[1]))
 
-    best_group = None
-    best_score = float("inf")
-    best_time_span = 0
-    best_angles = []
+    angles_mat = angle_mat.tolist()
+    scored = []
+    for _, group, _, t_min, t_max in beam:
+        # Same pair order and formula as group_score / select_top_n_groups
+        angles = [angles_mat[group[a]][group[b]] for a in range(k) for b in range(a + 1, k)]
+        time_span = (t_max - t_min) / 86400.0
+        score = sum(abs(a - target_angle) for a in angles) + abs(time_span - target_time_span)
+        scored.append((score, group, time_span, angles))
+    scored.sort(key=lambda x: (x[0], x[1]))
+    return scored[:n], stats
 
-    for group in combinations(image_infos, k):
-        score, time_span, angles = group_score(group)
-        if score < best_score:
-            best_score = score
-            best_group = group
-            best_time_span = time_span
-            best_angles = angles
+def select_best_k_images(image_infos, k=3, search="bnb", beam_width=DEFAULT_BEAM_WIDTH):
+    """
+    Select the best k images based on score.
+
+    search: "bnb" (exact branch-and-bound) or "beam" (approximate, for very large view sets).
+    """
+    if len(image_infos) <= k:
+        return image_infos, 0.0, [], 0.0
 
+    if search == "beam":
+        top, stats = select_top_n_groups_beam(image_infos, k=k, n=1, beam_width=beam_width)
+    else:
+        top, stats = select_top_n_groups(image_infos, k=k, n=1)
+    if not top:
+        return None, None, [], 0.0
+    best_score, best_idx, best_time_span, best_angles = top[0]
+    best_group = tuple(image_infos[i] for i in best_idx)
     return best_group, best_score, best_angles, best_time_span
 
-def process_image_folder(image_folder, metadata_root, k=3, output_name="selected_best.json"):
-    """Process a single image folder and select best k images"""
+def process_image_folder(image_folder, metadata_root, k=3, output_name="selected_best.json",
+                         search="bnb", beam_width=DEFAULT_BEAM_WIDTH, imd_dict=None,
+                         dsm_tile_dir=None, min_overlap=None, imd_db_path=None):
+    """
+    Process a single image folder and select best k images.
+
+    With min_overlap set, views whose footprint covers less than that fraction of the
+    DSM tile `dsm_tile_dir/<tile>.tif` are dropped first; overlaps go into the JSON.
+    min_overlap without dsm_tile_dir raises ValueError (the filter needs the tiles).
+    """
+    if min_overlap is not None and dsm_tile_dir is None:
+        raise ValueError("min_overlap requires dsm_tile_dir (the DSM tiles the footprints are checked against)")
     print(f"\n🔍 Processing: {image_folder}")
-    infos = collect_images_in_one_folder(image_folder, metadata_root)
+    infos = collect_images_in_one_folder(image_folder, metadata_root, imd_dict, imd_db_path)
+
+    view_overlap = None
+    if min_overlap is not None:
+        from footprint_overlap import filter_views_by_overlap
+        tile_name = os.path.basename(os.path.dirname(os.path.abspath(image_folder)))
+        n_before = len(infos)
+        infos, view_overlap = filter_views_by_overlap(infos, os.path.join(dsm_tile_dir, f"{tile_name}.tif"), min_overlap)
+        print(f"🧭 Footprint overlap filter: kept {len(infos)}/{n_before} views (min_overlap = {min_overlap})")
 
     if len(infos) < k:
         print(f"⚠️ Not enough images (required: {k}), skipping.")
-        return
+        return None
 
-    selected, best_score, best_angles, best_time_span = select_best_k_images(infos, k=k)
+    selected, best_score, best_angles, best_time_span = select_best_k_images(
+        infos, k=k, search=search, beam_width=beam_width)
+    if selected is None:
+        print("❌ No valid group found, skipping.")
+        return None
 
     print(f"✅ Best {k} images selected (score = {best_score:.2f}, span = {best_time_span:.2f} days, angles = {best_angles}):")
     for item in selected:
         print(item)
 
     output_json = os.path.join(image_folder, output_name)
-    save_selected_image_paths(selected, output_json)
+    save_selected_image_paths(selected, output_json, view_overlap)
     print(f"💾 JSON saved to: {output_json}")
+    return output_json
 
 def find_all_image_folders(dataset_root):
     """Find all subfolders named 'image' in the dataset root"""
@@ -179,18 +351,52 @@ def find_all_image_folders(dataset_root):
                 image_folders.append(os.path.join(root, d))
     return image_folders
 
-def process_all_image_folders(dataset_root, metadata_root, k=3):
-    """Process all 'image' folders in dataset root"""
-    image_folders = find_all_image_folders(dataset_root)
-    print(f"\n🔎 Found {len(image_folders)} image folders")
-    for image_folder in image_folders:
+def init_imd_index(metadata_root, db_path=None):
+    """Pool initializer: load the IMD index once per worker (the main process already refreshed the store)"""
+    global _IMD_DICT
+    _IMD_DICT = build_imd_index(metadata_root, load_imd_records(metadata_root, db_path=db_path, refresh=False))
+
+def process_image_folder_task(image_folder, metadata_root, k=3, search="bnb", beam_width=DEFAULT_BEAM_WIDTH,
+                              dsm_tile_dir=None, min_overlap=None):
+    """process_image_folder for run_folders: messages are captured into the result log instead of printed"""
+    if _IMD_DICT is None:
+        raise RuntimeError("IMD index not loaded: call init_imd_index(metadata_root) first "
+                           "(or use process_image_folder with imd_dict)")
+    buf = io.StringIO()
+    with redirect_stdout(buf):
         try:
-            process_image_folder(image_folder, metadata_root, k)
+            output_json = process_image_folder(image_folder, metadata_root, k, search=search,
+                                               beam_width=beam_width, imd_dict=_IMD_DICT,
+                                               dsm_tile_dir=dsm_tile_dir, min_overlap=min_overlap)
         except Exception as e:
-            print(f"❌ Failed to process: {image_folder}")
-            print(f"🚨 Error: {e}")
+            # keep what was printed before the failure, otherwise the log is lost with the exception
+            return {"status": "failed", "error": f"{type(e).__name__}: {e}",
+                    "traceback": traceback.format_exc(), "log": buf.getvalue().splitlines()}
+    return {"status": "ok" if output_json else "skipped", "log": buf.getvalue().splitlines(), "output": output_json}
+
+def process_all_image_folders(dataset_root, metadata_root, k=3, search="bnb", beam_width=DEFAULT_BEAM_WIDTH,
+                              max_workers=None, dsm_tile_dir=None, min_overlap=None, imd_db_path=None):
+    """
+    Process all 'image' folders in dataset root.
+
+    With max_workers > 1 the folders are spread over a process pool. Failures and
+    timings are collected per folder and summarized at the end; the results are returned.
+    imd_db_path places the IMD store elsewhere than metadata_root (e.g. a read-only tree).
+    """
+    if min_overlap is not None and dsm_tile_dir is None:
+        raise ValueError("min_overlap requires dsm_tile_dir (the DSM tiles the footprints are checked against)")
+    image_folders = find_all_image_folders(dataset_root)
+    print(f"\n🔎 Found {len(image_folders)} image folders")
+    # IMD metadata is parsed once into the store; each process then loads the index once (init_imd_index)
+    refresh_imd_store(metadata_root, imd_db_path)
+    task = partial(process_image_folder_task, metadata_root=metadata_root, k=k, search=search, beam_width=beam_width,
+                   dsm_tile_dir=dsm_tile_dir, min_overlap=min_overlap)
+    results = run_folders(task, image_folders, max_workers=max_workers,
+                          initializer=init_imd_index, initargs=(metadata_root, imd_db_path))
+    print_folder_summary(results)
+    return results
 
 if __name__ == "__main__":
     dataset_root = r"H:\IARPA_MVS_DATASET\MVS3D"  # Root path of dataset
     metadata_root = r"H:\IARPA_MVS_DATASET\IMD_ALL"
-    process_all_image_folders(dataset_root, metadata_root, k=5)
+    process_all_image_folders(dataset_root, metadata_root, k=5, max_workers=os.cpu_count())
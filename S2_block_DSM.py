@@ -1,12 +1,35 @@
 import os
 import glob
+import numpy as np
 import rasterio
 from rasterio.windows import Window
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def split_dsm_with_overlap(dsm_path, output_dir, tile_size=768, overlap=128):
+def tile_offsets(length, tile_size, step):
+    """与原逐块循环一致的起点序列：最后一块不足 tile_size 时向前平移（可能与前一块重复）"""
+    offsets = []
+    for start in range(0, length, step):
+        end = min(start + tile_size, length)
+        if end - start < tile_size:
+            start = max(0, end - tile_size)
+        offsets.append(start)
+    return offsets
+
+
+def write_tile(out_path, tile_profile, dsm_patch):
+    with rasterio.open(out_path, "w", **tile_profile) as dst:
+        dst.write(dsm_patch, 1)
+    return out_path
+
+
+def split_dsm_with_overlap(dsm_path, output_dir, tile_size=768, overlap=128, max_workers=4):
     """
     将DSM影像裁剪为指定tile大小的小块，可设置重叠像素，覆盖原图全部区域。
     文件命名方式为：原始DSM文件名_{tile_id:04d}.tif
+
+    每一行tile只读取一次高度为 tile_size 的整幅条带（与上一条带重叠的行直接复用），
+    在内存中切出该行所有tile，写文件交给 max_workers 个写线程；
+    排队中的写任务数有上限，内存占用约为一个条带加若干个tile。
     """
     os.makedirs(output_dir, exist_ok=True)
     base_name = os.path.splitext(os.path.basename(dsm_path))[0]
@@ -16,45 +39,53 @@ def split_dsm_with_overlap(dsm_path, output_dir, tile_size=768, overlap=128):
         height = src.height
         profile = src.profile
         step = tile_size - overlap
+        tops = tile_offsets(height, tile_size, step)
+        lefts = tile_offsets(width, tile_size, step)
         tile_id = 0
 
-        for top in range(0, height, step):
-            for left in range(0, width, step):
-                bottom = min(top + tile_size, height)
-                right = min(left + tile_size, width)
-
-                # 防止最后一块不足tile_size
-                if bottom - top < tile_size:
-                    top = max(0, bottom - tile_size)
-                if right - left < tile_size:
-                    left = max(0, right - tile_size)
-
-                window = Window(left, top, tile_size, tile_size)
-                transform = src.window_transform(window)
-                dsm_patch = src.read(1, window=window)
-
-                tile_profile = profile.copy()
-                tile_profile.update({
-                    "height": tile_size,
-                    "width": tile_size,
-                    "transform": transform,
-                })
+        strip, strip_top = None, None
+        max_pending = max_workers * 2
+        pending = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for top in tops:
+                if strip is not None and top == strip_top:
+                    pass  # 末行平移后与上一行相同，直接复用条带
+                elif strip is not None and strip_top < top < strip_top + tile_size:
+                    # 只解码新增的行，重叠部分从上一条带复制
+                    new_rows = src.read(1, window=Window(0, strip_top + tile_size, width, top - strip_top))
+                    strip = np.concatenate([strip[top - strip_top:], new_rows], axis=0)
+                else:
+                    strip = src.read(1, window=Window(0, top, width, tile_size))
+                strip_top = top
 
-                out_path = os.path.join(output_dir, f"{base_name}_{tile_id:04d}.tif")
-                with rasterio.open(out_path, "w", **tile_profile) as dst:
-                    dst.write(dsm_patch, 1)
+                for left in lefts:
+                    window = Window(left, top, tile_size, tile_size)
+                    tile_profile = profile.copy()
+                    tile_profile.update({
+                        "height": tile_size,
+                        "width": tile_size,
+                        "transform": src.window_transform(window),
+                    })
+                    dsm_patch = np.ascontiguousarray(strip[:, left:left + tile_size])
+                    out_path = os.path.join(output_dir, f"{base_name}_{tile_id:04d}.tif")
+                    pending.add(executor.submit(write_tile, out_path, tile_profile, dsm_patch))
+                    tile_id += 1
 
-                print(f"✅ Saved {out_path}")
-                tile_id += 1
+                    if len(pending) >= max_pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            print(f"✅ Saved {fut.result()}")
+            for fut in pending:
+                print(f"✅ Saved {fut.result()}")
 
     print(f"\n🎯 Finished! Total {tile_id} patches saved to: {output_dir}")
 
-def batch_split_all_dsms(dsm_dir, out_root, tile_size=1024, overlap=128):
+def batch_split_all_dsms(dsm_dir, out_root, tile_size=1024, overlap=128, max_workers=4):
     tif_files = glob.glob(os.path.join(dsm_dir, "*.tif"))
     for tif_path in tif_files:
         base = os.path.splitext(os.path.basename(tif_path))[0]
         output_dir = os.path.join(out_root, base + "_tiles")
-        split_dsm_with_overlap(tif_path, output_dir, tile_size, overlap)
+        split_dsm_with_overlap(tif_path, output_dir, tile_size, overlap, max_workers)
 
 if __name__ == "__main__":
     dsm_dir = r"H:\IARPA_MVS_DATASET\Challenge_Data_and_Software\Lidar_gt"
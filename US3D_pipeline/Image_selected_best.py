@@ -1,10 +1,25 @@
 import os
 import re
+import sys
 import math
 import json
 from glob import glob
 from datetime import datetime
 from itertools import combinations
+from functools import partial
+import heapq
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imd_store import load_imd_records, refresh_imd_store
+from folder_runner import run_folders, print_folder_summary
+from geo_utils import compute_pair_matrices
+
+# 束搜索（近似模式）默认每步保留的部分组合数
+DEFAULT_BEAM_WIDTH = 64
+
+# 当前进程使用的 IMD 记录（由 init_imd_records 设置，进程池中每个 worker 各一份）
+_IMD_RECORDS = None
 
 def parse_image_filename(filename):
     match = re.match(r"([A-Z]+)_(\d{3})_(\d{3})_RGB.tif", os.path.basename(filename))
@@ -57,6 +72,16 @@ def filter_and_score_pair(img_a, img_b, angle_range=(5, 45), max_incidence=35, m
         return True, time_diff, angle
     return False, None, None
 
+def compute_pair_validity(image_infos, angle_mat, time_diff_mat, angle_range=(5, 45), max_incidence=35,
+                          max_time_diff_days=90, min_elevation=35):
+    """filter_and_score_pair 的矩阵版本：n×n 布尔矩阵"""
+    el = np.array([info['el'] for info in image_infos], dtype=np.float64)
+    el_ok = el >= min_elevation
+    max_inc = np.maximum(90.0 - el[:, None], 90.0 - el[None, :])
+    return (el_ok[:, None] & el_ok[None, :] &
+            (angle_mat >= angle_range[0]) & (angle_mat <= angle_range[1]) &
+            (max_inc <= max_incidence) & (time_diff_mat <= max_time_diff_days))
+
 def score_group(group, ideal_angle=20.0):
     # 评分标准：时间跨度+偏离理想基线角度之和
     times = [item['datetime'] for item in group]
@@ -81,70 +106,247 @@ import json
 from glob import glob
 from itertools import combinations
 
-def process_all_best_group(dataset_root, metadata_root, k=5, n=3):
-    for root, dirs, files in os.walk(dataset_root):
-        if os.path.basename(root).lower() == 'image':
-            tif_files = sorted(glob(os.path.join(root, '*.tif')))
-            image_infos = []
-            for tif_path in tif_files:
-                region, dsm_id, img_id = parse_image_filename(tif_path)
-                if region is None:
-                    continue
-                imd_path = os.path.join(metadata_root, region, f"{int(img_id):02d}.IMD")
-                dt = extract_imd_datetime(imd_path)
-                az, el = extract_imd_angles(imd_path)
-                if None in (dt, az, el):
-                    continue
-                image_infos.append({
-                    'image_path': tif_path,
-                    'imd_path': imd_path,
-                    'datetime': dt,
-                    'az': az,
-                    'el': el,
-                })
-
-            if len(image_infos) < k:
-                print(f"⚠️ {root}: 影像不足{k}张，跳过")
+def score_index_group(group, angles, times, ideal_angle=20.0):
+    """按 score_group 的影像对顺序对索引组合求和（angles/times 为预计算矩阵的 list），得分与逐组评分一致"""
+    k = len(group)
+    pair_angles = [angles[group[i]][group[j]] for i in range(k) for j in range(i + 1, k)]
+    group_times = [times[i] for i in group]
+    time_span = (max(group_times) - min(group_times)) / 86400.0
+    avg_angle = sum(pair_angles) / len(pair_angles) if pair_angles else 0
+    angle_penalty = sum(abs(a - ideal_angle) for a in pair_angles) / len(pair_angles) if pair_angles else 0
+    return time_span + angle_penalty, time_span, avg_angle
+
+def find_top_groups_bnb(image_infos, k=5, n=3, ideal_angle=20.0):
+    """
+    分支定界精确搜索前 n 组，只保留一个大小为 n 的堆（内存 O(n)）。
+
+    按影像索引升序扩展组合（与 combinations 顺序一致），候选集只保留与已选影像两两合法的影像。
+    部分组合的下界 = 已有时间跨度 + 已有影像对的角度偏差之和 / 总影像对数：
+    继续加入影像只会让两项变大，若下界已超过当前第 n 名的得分则整棵子树剪掉。
+    得分相同时保留先出现的组合，与稳定排序后取前 n 组的结果一致。
+    """
+    angle_mat, time_diff_mat, times_seconds = compute_pair_matrices(image_infos)
+    valid = compute_pair_validity(image_infos, angle_mat, time_diff_mat).tolist()
+    angles = angle_mat.tolist()
+    times = times_seconds.tolist()
+    n_pairs = k * (k - 1) // 2
+    heap = []  # (-score, -seq, group, time_span, avg_angle)，堆顶为当前第 n 名
+    stats = {"leaves": 0, "pruned": 0}
+    seq = [0]
+
+    def worst_score():
+        return -heap[0][0] if len(heap) >= n else float('inf')
+
+    def extend(group, candidates, penalty_sum, t_min, t_max):
+        if len(group) == k:
+            score, time_span, avg_angle = score_index_group(group, angles, times, ideal_angle)
+            stats["leaves"] += 1
+            seq[0] += 1
+            item = (-score, -seq[0], tuple(group), time_span, avg_angle)
+            if len(heap) < n:
+                heapq.heappush(heap, item)
+            elif score < worst_score():
+                heapq.heapreplace(heap, item)
+            return
+
+        need = k - len(group)
+        for pos, i in enumerate(candidates):
+            if len(candidates) - pos < need:
+                break
+            new_penalty = penalty_sum + sum(abs(angles[g][i] - ideal_angle) for g in group)
+            new_min, new_max = min(t_min, times[i]), max(t_max, times[i])
+            lower_bound = (new_max - new_min) / 86400.0 + (new_penalty / n_pairs if n_pairs else 0)
+            if lower_bound > worst_score() + 1e-9:  # 留出浮点求和顺序带来的误差
+                stats["pruned"] += 1
                 continue
+            next_candidates = [j for j in candidates[pos + 1:] if valid[i][j]]
+            if len(next_candidates) >= need - 1:
+                extend(group + [i], next_candidates, new_penalty, new_min, new_max)
+
+    if 0 < k <= len(image_infos) and n > 0:
+        extend([], list(range(len(image_infos))), 0.0, float('inf'), float('-inf'))
+
+    top_n_groups = []
+    for neg_score, _, group, time_span, avg_angle in sorted(heap, key=lambda x: (-x[0], -x[1])):
+        top_n_groups.append({
+            "images": [os.path.basename(image_infos[i]['image_path']) for i in group],
+            "score": -neg_score,
+            "time_span": time_span,
+            "avg_angle": avg_angle
+        })
+    return top_n_groups, stats
+
+def find_top_groups_beam(image_infos, k=5, n=3, ideal_angle=20.0, beam_width=DEFAULT_BEAM_WIDTH):
+    """
+    束搜索近似选组（适用于 60~100 张候选影像、k 较大、精确搜索过慢的区块）。
 
-            all_valid_groups = []
-            for group in combinations(image_infos, k):
-                valid = all(
-                    filter_and_score_pair(group[i], group[j])[0]
-                    for i in range(k) for j in range(i+1, k)
-                )
-                if not valid:
-                    continue
-                score, time_span, avg_angle = score_group(group)
-                all_valid_groups.append({
-                    "images": [os.path.basename(i['image_path']) for i in group],
-                    "score": score,
-                    "time_span": time_span,
-                    "avg_angle": avg_angle
-                })
-
-            if not all_valid_groups:
-                print(f"❌ {root} - 没有找到合法组合")
+    从得分最好的 beam_width 个合法影像对出发，每步为每个部分组合尝试加入一张与组内影像两两合法的影像，
+    按与分支定界相同的部分得分（时间跨度 + 角度偏差之和 / 总影像对数）只保留最好的 beam_width 个，
+    直到组合大小为 k。每步代价约为 O(beam_width·k·n_views)，不保证全局最优。
+    k == 1 时无需近似，直接使用分支定界精确搜索。
+    """
+    if k < 2:
+        return find_top_groups_bnb(image_infos, k=k, n=n, ideal_angle=ideal_angle)
+    angle_mat, time_diff_mat, times_seconds = compute_pair_matrices(image_infos)
+    valid_mat = compute_pair_validity(image_infos, angle_mat, time_diff_mat)
+    n_views = len(image_infos)
+    n_pairs = k * (k - 1) // 2
+    stats = {"expanded": 0}
+    if k > n_views or n <= 0:
+        return [], stats
+
+    # 第一步：所有合法影像对的部分得分（矩阵已是 O(n²)，这里只是按索引取值）
+    pen_mat = np.abs(angle_mat - ideal_angle)
+    ii, jj = np.nonzero(np.triu(valid_mat, 1))
+    pair_scores = time_diff_mat[ii, jj] + pen_mat[ii, jj] / n_pairs
+    order = np.lexsort((jj, ii, pair_scores))[:beam_width]
+    # beam 中每项：(部分得分, 排序后的索引元组, 角度偏差之和, 最早时间, 最晚时间)
+    beam = [(float(pair_scores[o]), (int(ii[o]), int(jj[o])), float(pen_mat[ii[o], jj[o]]),
+             float(min(times_seconds[ii[o]], times_seconds[jj[o]])),
+             float(max(times_seconds[ii[o]], times_seconds[jj[o]]))) for o in order]
+
+    for _ in range(k - 2):
+        children = {}
+        for _, group, penalty_sum, t_min, t_max in beam:
+            idx = list(group)
+            mask = valid_mat[idx].all(axis=0)
+            mask[idx] = False
+            cand = np.nonzero(mask)[0]
+            if cand.size == 0:
                 continue
+            new_pen = penalty_sum + pen_mat[np.ix_(idx, cand)].sum(axis=0)
+            new_min = np.minimum(t_min, times_seconds[cand])
+            new_max = np.maximum(t_max, times_seconds[cand])
+            new_scores = (new_max - new_min) / 86400.0 + new_pen / n_pairs
+            stats["expanded"] += int(cand.size)
+            for c, sc, pen, lo, hi in zip(cand.tolist(), new_scores.tolist(), new_pen.tolist(),
+                                          new_min.tolist(), new_max.tolist()):
+                key = tuple(sorted(group + (c,)))
+                if key not in children:  # 同一组合可由不同父节点得到，只保留一次
+                    children[key] = (sc, key, pen, lo, hi)
+        beam = heapq.nsmallest(beam_width, children.values(), key=lambda x: (x[0], x[1]))
+        if not beam:
+            return [], stats
+
+    angles = angle_mat.tolist()
+    times = times_seconds.tolist()
+    scored = []
+    for _, group, _, _, _ in beam:
+        score, time_span, avg_angle = score_index_group(group, angles, times, ideal_angle)
+        scored.append((score, group, time_span, avg_angle))
+    scored.sort(key=lambda x: (x[0], x[1]))
+
+    top_n_groups = [{
+        "images": [os.path.basename(image_infos[i]['image_path']) for i in group],
+        "score": score,
+        "time_span": time_span,
+        "avg_angle": avg_angle
+    } for score, group, time_span, avg_angle in scored[:n]]
+    return top_n_groups, stats
+
+def init_imd_records(metadata_root, db_path=None):
+    """进程池 initializer：每个 worker 从元数据库读一次 IMD 记录（主进程已刷新过）"""
+    global _IMD_RECORDS
+    _IMD_RECORDS = load_imd_records(metadata_root, db_path=db_path, refresh=False)
+
+def get_imd_records(imd_records=None):
+    """显式传入的记录优先，否则使用 init_imd_records 加载的进程内记录"""
+    records = imd_records if imd_records is not None else _IMD_RECORDS
+    if records is None:
+        raise RuntimeError("IMD records not loaded: pass imd_records=load_imd_records(metadata_root) "
+                           "or call init_imd_records(metadata_root) first")
+    return records
+
+def select_best_group_in_folder(root, k=5, n=3, search="bnb", beam_width=DEFAULT_BEAM_WIDTH, min_overlap=None,
+                                imd_records=None):
+    """
+    单个 image 文件夹的选组任务（可在子进程中运行）。
+    imd_records 为 load_imd_records 的结果；为 None 时使用 init_imd_records 加载的记录。
+    输出信息写入返回结果的 log 列表，由主进程统一打印。
+    min_overlap 不为 None 时先按影像与块 DSM 的足迹重叠比例预筛，重叠比例写入 JSON 的 view_overlap。
+    """
+    log = []
+    imd_records = get_imd_records(imd_records)
+    tif_files = sorted(glob(os.path.join(root, '*.tif')))
+    image_infos = []
+    for tif_path in tif_files:
+        region, dsm_id, img_id = parse_image_filename(tif_path)
+        if region is None:
+            continue
+        rec = imd_records.get((region, f"{int(img_id):02d}"))
+        if rec is None or None in (rec['datetime'], rec['sat_az'], rec['sat_el']):
+            continue
+        image_infos.append({
+            'image_path': tif_path,
+            'imd_path': rec['path'],
+            'datetime': rec['datetime'],
+            'az': rec['sat_az'],
+            'el': rec['sat_el'],
+        })
+
+    # 足迹重叠预筛：DSM 块角点 × 高程范围经 RPC 投影，覆盖比例低于 min_overlap 的影像不参与组合枚举
+    view_overlap = None
+    if min_overlap is not None:
+        from footprint_overlap import filter_views_by_overlap, us3d_dsm_path
+        n_before = len(image_infos)
+        image_infos, view_overlap = filter_views_by_overlap(image_infos, us3d_dsm_path, min_overlap, log)
+        log.append(f"🧭 {root} - 足迹重叠预筛: 保留 {len(image_infos)}/{n_before} 张 (阈值 {min_overlap})")
+
+    if len(image_infos) < k:
+        log.append(f"⚠️ {root}: 影像不足{k}张，跳过")
+        return {"status": "skipped", "log": log, "n_views": len(image_infos)}
+
+    # search="bnb"：分支定界 + 大小为 n 的堆（精确）；
+    # "beam"：束搜索近似模式（与精确搜索的得分差见 bench_view_selection.compare_beam_searches）
+    if search == "beam":
+        top_n_groups, search_stats = find_top_groups_beam(image_infos, k=k, n=n, beam_width=beam_width)
+    else:
+        top_n_groups, search_stats = find_top_groups_bnb(image_infos, k=k, n=n)
+
+    if not top_n_groups:
+        log.append(f"❌ {root} - 没有找到合法组合")
+        return {"status": "skipped", "log": log, "n_views": len(image_infos)}
+
+    if "expanded" in search_stats:
+        log.append(f"📊 {root} - 束搜索扩展候选数: {search_stats['expanded']} (beam={beam_width})")
+    else:
+        log.append(f"📊 {root} - 完整评分组合数: {search_stats['leaves']}, 剪枝分支数: {search_stats['pruned']}")
 
-            # 按得分升序排序，选取前n组
-            top_n_groups = sorted(all_valid_groups, key=lambda x: x["score"])[:n]
-            print(f"📊 {root} - 合法组合总数: {len(all_valid_groups)}")
+    # 删除旧文件
+    out_json = os.path.join(root, 'selected_best.json')
+    if os.path.exists(out_json):
+        os.remove(out_json)
 
-            # 删除旧文件
-            out_json = os.path.join(root, 'selected_best.json')
-            if os.path.exists(out_json):
-                os.remove(out_json)
+    # 保存为新文件
+    with open(out_json, 'w') as f:
+        result = {"top_groups": top_n_groups}
+        if view_overlap is not None:
+            result["view_overlap"] = view_overlap
+        json.dump(result, f, indent=2)
 
-            # 保存为新文件
-            with open(out_json, 'w') as f:
-                json.dump({"top_groups": top_n_groups}, f, indent=2)
+    log.append(f"✅ {root} - 最优前{n}组已保存: {out_json}")
+    for idx, g in enumerate(top_n_groups):
+        log.append(f"  [{idx+1}] score={g['score']:.2f}, avg_angle={g['avg_angle']:.2f}, time_span={g['time_span']:.1f}天")
+    return {"status": "ok", "log": log, "n_views": len(image_infos), "output": out_json}
 
-            print(f"✅ {root} - 最优前{n}组已保存: {out_json}")
-            for idx, g in enumerate(top_n_groups):
-                print(f"  [{idx+1}] score={g['score']:.2f}, avg_angle={g['avg_angle']:.2f}, time_span={g['time_span']:.1f}天")
+def process_all_best_group(dataset_root, metadata_root, k=5, n=3, search="bnb",
+                           beam_width=DEFAULT_BEAM_WIDTH, max_workers=None, min_overlap=None, imd_db_path=None):
+    """
+    遍历 dataset_root 下所有 image 文件夹选组。max_workers > 1 时各文件夹分配到进程池并行处理；
+    每个文件夹的失败信息与耗时汇总到返回的结果列表中。
+    imd_db_path：IMD 元数据库位置，默认 metadata_root/imd_store.sqlite（元数据目录只读时另行指定）。
+    """
+    # 所有 IMD 只在元数据库中解析一次（按 mtime 增量刷新）；记录由 initializer 在每个进程中加载一次，各区块直接查表
+    refresh_imd_store(metadata_root, imd_db_path)
+    folders = [root for root, dirs, files in os.walk(dataset_root) if os.path.basename(root).lower() == 'image']
+    task = partial(select_best_group_in_folder, k=k, n=n, search=search,
+                   beam_width=beam_width, min_overlap=min_overlap)
+    results = run_folders(task, folders, max_workers=max_workers,
+                          initializer=init_imd_records, initargs=(metadata_root, imd_db_path))
+    print_folder_summary(results)
+    return results
 
 if __name__ == "__main__":
     dataset_root = r"H:\MVS-Dataset\Test2"
     metadata_root = r"H:\MVS-Dataset\Track3-Metadata"
-    process_all_best_group(dataset_root, metadata_root, k=5, n=10)
+    process_all_best_group(dataset_root, metadata_root, k=5, n=10, max_workers=os.cpu_count())
@@ -1,27 +1,88 @@
 import os
 import re
+import sys
 import math
 import json
 from glob import glob
 from datetime import datetime
-from itertools import combinations
+from itertools import islice
+from functools import partial
 import random
+import numpy as np
 
-def find_all_valid_groups(image_infos, k=3, angle_range=(5, 45), max_incidence=40):
-    valid_groups = []
-    for group in combinations(image_infos, k):
-        passes = True
-        for i in range(k):
-            for j in range(i + 1, k):
-                valid, _, _ = filter_and_score_pair(group[i], group[j], angle_range, max_incidence)
-                if not valid:
-                    passes = False
-                    break
-            if not passes:
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imd_store import load_imd_records, refresh_imd_store
+from folder_runner import run_folders, print_folder_summary, folder_seed
+from geo_utils import compute_pair_matrices, GROUP_BATCH_SIZE
+
+# 当前进程使用的 IMD 记录（由 init_imd_records 设置，进程池中每个 worker 各一份）
+_IMD_RECORDS = None
+
+def build_pair_validity_matrix(image_infos, angle_range=(5, 45), max_incidence=40):
+    """
+    n×n 两两可用矩阵（numpy 布尔数组），每对影像只调用一次 filter_and_score_pair。
+    组合枚举与推荐组选择共用这一份矩阵，阈值边界上的判断因此一致。
+    """
+    n = len(image_infos)
+    valid = np.zeros((n, n), dtype=bool)
+    for i in range(n):
+        for j in range(i + 1, n):
+            ok, _, _ = filter_and_score_pair(image_infos[i], image_infos[j], angle_range, max_incidence)
+            valid[i, j] = valid[j, i] = ok
+    return valid
+
+def iter_valid_index_groups(valid, k=3):
+    """
+    按 combinations 的字典序逐个产出可用矩阵 valid 中的 k-团（影像索引元组）。
+    回溯时候选集只保留与已选影像全部相容的影像，候选不足时直接剪枝，不会展开任何非法分支。
+    """
+    valid = np.asarray(valid).tolist()
+    n = len(valid)
+
+    def extend(group, candidates):
+        if len(group) == k:
+            yield tuple(group)
+            return
+        need = k - len(group)
+        for pos, i in enumerate(candidates):
+            if len(candidates) - pos < need:
                 break
-        if passes:
-            valid_groups.append(group)
-    return valid_groups
+            next_candidates = [j for j in candidates[pos + 1:] if valid[i][j]]
+            if len(next_candidates) >= need - 1:
+                yield from extend(group + [i], next_candidates)
+
+    if 0 < k <= n:
+        yield from extend([], list(range(n)))
+
+def iter_valid_groups(image_infos, k=3, angle_range=(5, 45), max_incidence=40, valid=None):
+    """
+    按 combinations 的字典序逐个产出合法的 k 影像组合（两两均通过筛选）。
+    valid 为 build_pair_validity_matrix 的结果，为 None 时在此构建。
+    """
+    if valid is None:
+        valid = build_pair_validity_matrix(image_infos, angle_range, max_incidence)
+    for group in iter_valid_index_groups(valid, k):
+        yield tuple(image_infos[i] for i in group)
+
+def find_all_valid_groups(image_infos, k=3, angle_range=(5, 45), max_incidence=40):
+    return list(iter_valid_groups(image_infos, k, angle_range, max_incidence))
+
+def reservoir_sample(iterable, size, rng=None):
+    """
+    蓄水池采样（Algorithm R）：单次遍历从任意长的序列中等概率抽取 size 个元素，内存 O(size)。
+    返回 (样本列表, 遍历到的元素总数)；给定 rng 种子时结果可复现。
+    """
+    rng = rng or random.Random()
+    sample = []
+    count = 0
+    for count, item in enumerate(iterable, 1):
+        if len(sample) < size:
+            sample.append(item)
+        else:
+            j = rng.randrange(count)
+            if j < size:
+                sample[j] = item
+    return sample, count
 
 def parse_image_filename(filename):
     match = re.match(r"([A-Z]+)_(\d{3})_(\d{3})_RGB.tif", os.path.basename(filename))
@@ -78,91 +139,127 @@ def filter_and_score_pair(img_a, img_b, angle_range=(5, 45), max_incidence=40):
     return False, None, None
 
 
-def select_us3d_recommended_group(image_infos, k=3):
+def select_us3d_recommended_group(image_infos, k=3, valid=None):
+    """
+    在全部合法 k 影像组合中选出得分（两两时间差之和 + 交会角偏离 20° 之和）最低的一组。
+    valid 为 build_pair_validity_matrix 的结果（与组合枚举共用同一份），为 None 时在此构建。
+    """
     if len(image_infos) < k:
         return image_infos, 0.0
 
-    from itertools import combinations
+    # 两两交会角/时间差只算一次；合法组合由可用矩阵的 k-团枚举得到，按批从矩阵中取值评分
+    angle_mat, time_diff_mat, _ = compute_pair_matrices(image_infos)
+    if valid is None:
+        valid = build_pair_validity_matrix(image_infos)
+    ii, jj = np.triu_indices(k, 1)
     best_group, best_score = None, float('inf')
 
-    for group in combinations(image_infos, k):
-        passes = True
-        angles, time_diffs = [], []
-        for i in range(k):
-            for j in range(i + 1, k):
-                valid, t_diff, ang = filter_and_score_pair(group[i], group[j])
-                if not valid:
-                    passes = False
-                    break
-                time_diffs.append(t_diff)
-                angles.append(ang)
-            if not passes:
-                break
-        if not passes:
+    valid_groups = iter_valid_index_groups(valid, k)
+    while True:
+        groups = np.array(list(islice(valid_groups, GROUP_BATCH_SIZE)), dtype=np.int64).reshape(-1, k)
+        if len(groups) == 0:
+            break
+        a, b = groups[:, ii], groups[:, jj]
+        scores = time_diff_mat[a, b].sum(axis=1) + np.abs(angle_mat[a, b] - 20.0).sum(axis=1)  # 20°是最优角度
+        pos = int(np.argmin(scores))
+        if scores[pos] < best_score:
+            best_score = float(scores[pos])
+            best_group = [image_infos[i] for i in groups[pos]]
+
+    return best_group if best_group else [], best_score
+
+def init_imd_records(metadata_root, db_path=None):
+    """进程池 initializer：每个 worker 从元数据库读一次 IMD 记录（主进程已刷新过）"""
+    global _IMD_RECORDS
+    _IMD_RECORDS = load_imd_records(metadata_root, db_path=db_path, refresh=False)
+
+def get_imd_records(imd_records=None):
+    """显式传入的记录优先，否则使用 init_imd_records 加载的进程内记录"""
+    records = imd_records if imd_records is not None else _IMD_RECORDS
+    if records is None:
+        raise RuntimeError("IMD records not loaded: pass imd_records=load_imd_records(metadata_root) "
+                           "or call init_imd_records(metadata_root) first")
+    return records
+
+def sample_groups_in_folder(root, dataset_root, k=3, min_groups=100, max_groups=300, random_seed=42,
+                            min_overlap=None, imd_records=None):
+    """
+    单个 image 文件夹的采样任务（可在子进程中运行）。
+    imd_records 为 load_imd_records 的结果；为 None 时使用 init_imd_records 加载的记录。
+    随机种子由 random_seed 与文件夹相对路径决定，与 worker 数量和处理顺序无关。
+    min_overlap 不为 None 时先按影像与块 DSM 的足迹重叠比例预筛，重叠比例写入 JSON 的 view_overlap。
+    """
+    log = []
+    imd_records = get_imd_records(imd_records)
+    out_json = os.path.join(root, 'selected_all_combinations.json')
+    if os.path.exists(out_json):
+        os.remove(out_json)
+    tif_files = sorted(glob(os.path.join(root, '*.tif')))
+    image_infos = []
+    for tif_path in tif_files:
+        region, dsm_id, img_id = parse_image_filename(tif_path)
+        if region is None:
+            continue
+        rec = imd_records.get((region, f"{int(img_id):02d}"))
+        if rec is None or None in (rec['datetime'], rec['sat_az'], rec['sat_el']):
             continue
+        image_infos.append({
+            'image_path': tif_path,
+            'imd_path': rec['path'],
+            'datetime': rec['datetime'],
+            'az': rec['sat_az'],
+            'el': rec['sat_el'],
+        })
+
+    # 足迹重叠预筛：DSM 块角点 × 高程范围经 RPC 投影，覆盖比例低于 min_overlap 的影像不参与组合枚举
+    view_overlap = None
+    if min_overlap is not None:
+        from footprint_overlap import filter_views_by_overlap, us3d_dsm_path
+        n_before = len(image_infos)
+        image_infos, view_overlap = filter_views_by_overlap(image_infos, us3d_dsm_path, min_overlap, log)
+        log.append(f"🧭 {root} - 足迹重叠预筛: 保留 {len(image_infos)}/{n_before} 张 (阈值 {min_overlap})")
+
+    # 合法组合按生成器逐个产出（combinations 不会重复，无需去重），
+    # 直接送入蓄水池采样，内存只与 max_groups 有关
+    seed = folder_seed(root, dataset_root, random_seed)
+    unique_groups, n_all = reservoir_sample(iter_valid_groups(image_infos, k=k), max_groups, random.Random(seed))
+    log.append(f"✅ {root} - 可用{n_all}组k={k}影像组合")
+    if n_all > max_groups:
+        log.append(f"🔹 超过{max_groups}组，随机采样{max_groups}组")
+    elif n_all < min_groups:
+        log.append(f"⚠️ 仅有{n_all}组，低于建议的{min_groups}组，全保留")
+    # 保存
+    all_combos = [
+        [os.path.basename(item['image_path']) for item in group]
+        for group in unique_groups
+    ]
+    with open(out_json, 'w') as f:
+        result = {"all_combinations": all_combos}
+        if view_overlap is not None:
+            result["view_overlap"] = view_overlap
+        json.dump(result, f, indent=2)
+    log.append(f"  ✉ 已保存{len(all_combos)}组到: {out_json}")
+    return {"status": "ok", "log": log, "valid_groups": n_all, "saved_groups": len(all_combos), "seed": seed}
 
-        score = sum(time_diffs) + sum(abs(a - 20.0) for a in angles)  # 20°是最优角度
-        if score < best_score:
-            best_score = score
-            best_group = group
-
-    return list(best_group) if best_group else [], best_score
-
-def process_all_us3d_pairs_all_combinations(dataset_root, metadata_root, k=3, min_groups=100, max_groups=300, random_seed=42):
-    random.seed(random_seed)
-    for root, dirs, files in os.walk(dataset_root):
-        if os.path.basename(root).lower() == 'image':
-            out_json = os.path.join(root, 'selected_all_combinations.json')
-            if os.path.exists(out_json):
-                os.remove(out_json)
-            tif_files = sorted(glob(os.path.join(root, '*.tif')))
-            image_infos = []
-            for tif_path in tif_files:
-                region, dsm_id, img_id = parse_image_filename(tif_path)
-                if region is None:
-                    continue
-                imd_path = os.path.join(metadata_root, region, f"{int(img_id):02d}.IMD")
-                dt = extract_imd_datetime(imd_path)
-                az, el = extract_imd_angles(imd_path)
-                if None in (dt, az, el):
-                    continue
-                image_infos.append({
-                    'image_path': tif_path,
-                    'imd_path': imd_path,
-                    'datetime': dt,
-                    'az': az,
-                    'el': el,
-                })
-
-            valid_groups = find_all_valid_groups(image_infos, k=k)
-            # ---- 新增：去重（组合排序后hash判重）
-            combo_set = set()
-            unique_groups = []
-            for group in valid_groups:
-                key = tuple(sorted(os.path.basename(item['image_path']) for item in group))
-                if key not in combo_set:
-                    combo_set.add(key)
-                    unique_groups.append(group)
-
-            n_all = len(unique_groups)
-            print(f"✅ {root} - 去重后可用{n_all}组k={k}影像组合")
-            # ---- 随机采样
-            if n_all > max_groups:
-                unique_groups = random.sample(unique_groups, max_groups)
-                print(f"🔹 超过{max_groups}组，随机采样{max_groups}组")
-            elif n_all < min_groups:
-                print(f"⚠️ 仅有{n_all}组，低于建议的{min_groups}组，全保留")
-            # 保存
-            all_combos = [
-                [os.path.basename(item['image_path']) for item in group]
-                for group in unique_groups
-            ]
-            with open(out_json, 'w') as f:
-                json.dump({"all_combinations": all_combos}, f, indent=2)
-            print(f"  ✉ 已保存{len(all_combos)}组到: {out_json}")
+def process_all_us3d_pairs_all_combinations(dataset_root, metadata_root, k=3, min_groups=100, max_groups=300,
+                                            random_seed=42, max_workers=None, min_overlap=None, imd_db_path=None):
+    """
+    遍历 dataset_root 下所有 image 文件夹采样组合。max_workers > 1 时使用进程池；
+    结果只取决于 random_seed 与文件夹路径。每个文件夹的失败信息与耗时汇总到返回的结果列表中。
+    imd_db_path：IMD 元数据库位置，默认 metadata_root/imd_store.sqlite（元数据目录只读时另行指定）。
+    """
+    # 所有 IMD 只在元数据库中解析一次（按 mtime 增量刷新）；记录由 initializer 在每个进程中加载一次，各区块直接查表
+    refresh_imd_store(metadata_root, imd_db_path)
+    folders = [root for root, dirs, files in os.walk(dataset_root) if os.path.basename(root).lower() == 'image']
+    task = partial(sample_groups_in_folder, dataset_root=dataset_root, k=k, min_groups=min_groups,
+                   max_groups=max_groups, random_seed=random_seed, min_overlap=min_overlap)
+    results = run_folders(task, folders, max_workers=max_workers,
+                          initializer=init_imd_records, initargs=(metadata_root, imd_db_path))
+    print_folder_summary(results)
+    return results
 
 
 if __name__ == "__main__":
     dataset_root = r"H:\MVS-Dataset\Test"  # 数据集根目录
     metadata_root = r"H:\MVS-Dataset\Track3-Metadata"
-    process_all_us3d_pairs_all_combinations(dataset_root, metadata_root, k=5)
+    process_all_us3d_pairs_all_combinations(dataset_root, metadata_root, k=5, max_workers=os.cpu_count())
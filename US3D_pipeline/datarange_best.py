@@ -1,8 +1,13 @@
 import os
-import shutil
+import sys
 import json
 
-def organize_single_selected_json(image_folder, out_root):
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from link_files import materialize_file, LinkStats
+from group_manifest import write_group_manifest
+from bulk_copy import bulk_copy
+
+def organize_single_selected_json(image_folder, out_root, link_mode="copy", stats=None, plan=None):
     """
     Organize image/RPC/height/DSM files into per-combination folders
     based on 'selected_best.json' which contains top N combinations.
@@ -10,6 +15,11 @@ def organize_single_selected_json(image_folder, out_root):
     Args:
         image_folder (str): Path to the folder containing satellite images and JSON files.
         out_root (str): Output root directory for grouped combinations.
+        link_mode (str): "copy", "hardlink", "reflink" or "symlink" (see link_files.py);
+            falls back to copy where the link is not possible.
+        stats (LinkStats): Optional accumulator of files materialized and bytes saved.
+        plan (list): If given, (src, dst) pairs are appended to it instead of being
+            materialized, so a whole run can be handed to bulk_copy.
     """
     block_dir = os.path.dirname(image_folder)
     heightmap2_dir = os.path.join(block_dir, "heightmap2")
@@ -58,8 +68,10 @@ def organize_single_selected_json(image_folder, out_root):
             src_img = os.path.join(image_folder, img_file)
             dst_img = os.path.join(img_dir, img_file)
             if os.path.exists(src_img):
-                if not os.path.exists(dst_img):
-                    shutil.copy(src_img, dst_img)
+                if plan is not None:
+                    plan.append((src_img, dst_img))
+                elif not os.path.exists(dst_img):
+                    materialize_file(src_img, dst_img, link_mode, stats)
                 else:
                     print(f"⏩ Skip image (already exists): {dst_img}")
             else:
@@ -70,8 +82,10 @@ def organize_single_selected_json(image_folder, out_root):
             src_rpc = os.path.join(image_folder, rpc_file)
             dst_rpc = os.path.join(rpc_dir, rpc_file)
             if os.path.exists(src_rpc):
-                if not os.path.exists(dst_rpc):
-                    shutil.copy(src_rpc, dst_rpc)
+                if plan is not None:
+                    plan.append((src_rpc, dst_rpc))
+                elif not os.path.exists(dst_rpc):
+                    materialize_file(src_rpc, dst_rpc, link_mode, stats)
                 else:
                     print(f"⏩ Skip RPC (already exists): {dst_rpc}")
             else:
@@ -82,8 +96,10 @@ def organize_single_selected_json(image_folder, out_root):
             src_height = os.path.join(heightmap2_dir, height_file)
             dst_height = os.path.join(height_dir, height_file)
             if os.path.exists(src_height):
-                if not os.path.exists(dst_height):
-                    shutil.copy(src_height, dst_height)
+                if plan is not None:
+                    plan.append((src_height, dst_height))
+                elif not os.path.exists(dst_height):
+                    materialize_file(src_height, dst_height, link_mode, stats)
                 else:
                     print(f"⏩ Skip heightmap (already exists): {dst_height}")
             else:
@@ -94,8 +110,10 @@ def organize_single_selected_json(image_folder, out_root):
         dsm_src = os.path.join(dsm_dir, dsm_file)
         dsm_dst = os.path.join(dsm_out_dir, dsm_file)
         if os.path.exists(dsm_src):
-            if not os.path.exists(dsm_dst):
-                shutil.copy(dsm_src, dsm_dst)
+            if plan is not None:
+                plan.append((dsm_src, dsm_dst))
+            elif not os.path.exists(dsm_dst):
+                materialize_file(dsm_src, dsm_dst, link_mode, stats)
             else:
                 print(f"⏩ Skip DSM (already exists): {dsm_dst}")
         else:
@@ -104,17 +122,37 @@ def organize_single_selected_json(image_folder, out_root):
         print(f"✅ Group created: {group_name}")
 
 
-def batch_organize_all_selected_json(dataset_root, out_root):
+def batch_organize_all_selected_json(dataset_root, out_root, link_mode="copy", bulk=False, max_workers=8):
     """
     Recursively scan for image folders and process only 'selected_best.json'.
+    Files are materialized with link_mode and the bytes saved are reported at the end.
+    With bulk=True all (src, dst) pairs are planned first and transferred by the
+    concurrent bulk copier (deduplicated, skipping complete destinations).
     """
+    stats = LinkStats()
+    plan = [] if bulk else None
     for root, dirs, files in os.walk(dataset_root):
         if os.path.basename(root).lower() == "image":
-            organize_single_selected_json(root, out_root)
+            organize_single_selected_json(root, out_root, link_mode, stats, plan)
+    if bulk:
+        return bulk_copy(plan, max_workers=max_workers, link_mode=link_mode, stats=stats)
+    stats.report()
+    return stats
+
+
+def batch_write_manifest(dataset_root, manifest_path):
+    """
+    Manifest-only alternative to batch_organize_all_selected_json: write one JSON Lines record per group
+    (member paths relative to dataset_root) without creating any group folder.
+    Load it lazily with group_manifest.GroupManifestDataset.
+    """
+    return write_group_manifest(dataset_root, manifest_path, source="best")
 
 
 # 用法示例
 if __name__ == "__main__":
     dataset_root = r"H:\MVS-Dataset\Test2"
     out_root = r"H:\MVS-Dataset\US3D-MVS\Test"
-    batch_organize_all_selected_json(dataset_root, out_root)
+    batch_organize_all_selected_json(dataset_root, out_root, link_mode="copy")
+    # 同一磁盘上可改用硬链接省去复制：link_mode="hardlink"（输出与源文件共享数据，修改一方会影响另一方）
+    # 或只生成清单（不复制文件）：batch_write_manifest(dataset_root, os.path.join(out_root, "manifest.jsonl"))
@@ -1,8 +1,13 @@
 import os
-import shutil
+import sys
 import json
 
-def organize_selected_images(image_folder, out_root, group_name_prefix=""):
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from link_files import materialize_file, LinkStats
+from group_manifest import write_group_manifest
+from bulk_copy import bulk_copy
+
+def organize_selected_images(image_folder, out_root, group_name_prefix="", link_mode="copy", stats=None, plan=None):
     json_path = os.path.join(image_folder, "selected_all_combinations.json")
     if not os.path.exists(json_path):
         print(f"❌ 找不到: {json_path}")
@@ -32,8 +37,10 @@ def organize_selected_images(image_folder, out_root, group_name_prefix=""):
             src_img = os.path.join(image_folder, img_file)
             dst_img = os.path.join(group_dir, "image", img_file)
             if os.path.exists(src_img):
-                if not os.path.exists(dst_img):
-                    shutil.copy(src_img, dst_img)
+                if plan is not None:
+                    plan.append((src_img, dst_img))
+                elif not os.path.exists(dst_img):
+                    materialize_file(src_img, dst_img, link_mode, stats)
                 else:
                     print(f"✅ 已存在影像: {dst_img}")
             else:
@@ -44,8 +51,10 @@ def organize_selected_images(image_folder, out_root, group_name_prefix=""):
             src_rpc = os.path.join(image_folder, rpc_file)
             dst_rpc = os.path.join(group_dir, "rpc", rpc_file)
             if os.path.exists(src_rpc):
-                if not os.path.exists(dst_rpc):
-                    shutil.copy(src_rpc, dst_rpc)
+                if plan is not None:
+                    plan.append((src_rpc, dst_rpc))
+                elif not os.path.exists(dst_rpc):
+                    materialize_file(src_rpc, dst_rpc, link_mode, stats)
                 else:
                     print(f"✅ 已存在RPC: {dst_rpc}")
             else:
@@ -56,8 +65,10 @@ def organize_selected_images(image_folder, out_root, group_name_prefix=""):
             src_height = os.path.join(heightmap2_dir, height_file)
             dst_height = os.path.join(group_dir, "height", height_file)
             if os.path.exists(src_height):
-                if not os.path.exists(dst_height):
-                    shutil.copy(src_height, dst_height)
+                if plan is not None:
+                    plan.append((src_height, dst_height))
+                elif not os.path.exists(dst_height):
+                    materialize_file(src_height, dst_height, link_mode, stats)
                 else:
                     print(f"✅ 已存在 Heightmap: {dst_height}")
             else:
@@ -69,7 +80,10 @@ def organize_selected_images(image_folder, out_root, group_name_prefix=""):
         dsm_dst = os.path.join(group_dir, "DSM", dsm_filename.replace("_geo",""))
         if os.path.exists(dsm_src):
             # if not os.path.exists(dsm_dst):
-            shutil.copy(dsm_src, dsm_dst)
+            if plan is not None:
+                plan.append((dsm_src, dsm_dst))
+            else:
+                materialize_file(dsm_src, dsm_dst, link_mode, stats)
         #     else:
         #         print(f"✅ 已存在 DSM: {dsm_dst}")
         # else:
@@ -80,13 +94,33 @@ def organize_selected_images(image_folder, out_root, group_name_prefix=""):
 
 
 
-def batch_organize_all(dataset_root, out_root):
+def batch_organize_all(dataset_root, out_root, link_mode="copy", bulk=False, max_workers=8):
+    # link_mode: "copy" / "hardlink" / "reflink" / "symlink"，无法链接时自动退回复制（见 link_files.py）
+    # bulk=True：先规划全部 (src, dst)，再由并发复制引擎统一传输（去重、按大小/mtime 跳过已完成的文件）
+    stats = LinkStats()
+    plan = [] if bulk else None
     for root, dirs, files in os.walk(dataset_root):
         if os.path.basename(root).lower() == "image":
-            organize_selected_images(root, out_root)
+            organize_selected_images(root, out_root, link_mode=link_mode, stats=stats, plan=plan)
+    if bulk:
+        return bulk_copy(plan, max_workers=max_workers, link_mode=link_mode, stats=stats)
+    stats.report()
+    return stats
+
+
+def batch_write_manifest(dataset_root, manifest_path):
+    """
+    Manifest-only alternative to batch_organize_all: write one JSON Lines record per group
+    (member paths relative to dataset_root) without creating any group folder.
+    Load it lazily with group_manifest.GroupManifestDataset.
+    """
+    return write_group_manifest(dataset_root, manifest_path, source="sample")
+
 
 # 用法示例
 if __name__ == "__main__":
     dataset_root = r"H:\MVS-Dataset\Test2"
     out_root = r"H:\MVS-Dataset\US3D-MVS\Train"
-    batch_organize_all(dataset_root, out_root)
+    batch_organize_all(dataset_root, out_root, link_mode="copy")
+    # 同一磁盘上可改用硬链接省去复制：link_mode="hardlink"（输出与源文件共享数据，修改一方会影响另一方）
+    # 或只生成清单（不复制文件）：batch_write_manifest(dataset_root, os.path.join(out_root, "manifest.jsonl"))
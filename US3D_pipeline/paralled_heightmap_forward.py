@@ -1,62 +1,740 @@
 import os
 import sys
 import glob
+import json
+import time
+import warnings
+from collections import OrderedDict, deque
+from functools import partial
+from multiprocessing import shared_memory
 import numpy as np
 import rasterio
-from concurrent.futures import ProcessPoolExecutor
+from rasterio.windows import Window, transform as window_transform
+from concurrent.futures import ProcessPoolExecutor, wait
 from tqdm import tqdm
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
 # 添加你的 RPCCore 路径
 from RPCCore import RPCModelParameter
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rpc_approx import ApproxRPCProjector, make_approx_projector
+from geo_utils import find_rpc_file, lonlat_transformers
+
+# 每批送入 RPC 的 DSM 格网数上限，用于控制内存占用
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+# 多个 DSM 格网落到同一像素时的处理方式：
+#   "last"    - 沿用逐像素循环的结果，按行优先顺序后写覆盖先写
+#   "zbuffer" - 保留视线方向上最高（对传感器可见）的点，与遍历顺序无关
+PROJECTION_MODES = ("last", "zbuffer")
+
+# 生成方式：上面两种为 DSM→影像 的正向投影；"inverse" 为 影像→地面 的反向求交，逐像素稠密
+GENERATION_MODES = PROJECTION_MODES + ("inverse",)
+
+# 反向求交的迭代参数（高程收敛阈值，单位米）
+INVERSE_MAX_ITER = 20
+INVERSE_TOLERANCE = 0.05
+
+# 流式模式下 GDAL 块缓存上限（MB），保证内存上界与 DSM 大小无关
+STREAMING_GDAL_CACHEMAX_MB = 64
+
+# 近似投影（控制网格插值）的最大像素误差；None 表示始终使用精确 RPC
+DEFAULT_APPROX_MAX_ERROR = None
+
+# 影像范围裁剪 DSM 时向外扩展的保护边界（DSM 格网数）
+FOOTPRINT_MARGIN = 8
+
+# 流式模式估计 DSM 高程范围：降采样预览的最大边长（像素），以及范围向两侧外扩的比例（预览可能漏掉极值）
+HEIGHT_RANGE_PREVIEW_SIZE = 1024
+HEIGHT_RANGE_PAD = 0.1
+
+# 多分辨率高度图金字塔：第 k 层为 1/2^k 分辨率，写为同目录的 *_heightmap_d{2^k}.tif
+PYRAMID_METHODS = ("min", "max", "mean")
+
+# 统计信息 sidecar 中记录的高程分位数
+STATS_PERCENTILES = (2, 25, 50, 75, 98)
+
+
+# ---------------- DSM 坐标系：地理坐标直接使用，投影坐标（如 MVS3D 的 UTM 分块）批量转换为经纬度 ----------------
+
+def dsm_pixel_to_lonlat(dsm_transform, dsm_crs, cols, rows):
+    """Map (fractional) DSM pixel coordinates to lon/lat arrays."""
+    x, y = dsm_transform * (cols, rows)
+    transformers = lonlat_transformers(dsm_crs)
+    if transformers is None:
+        return x, y
+    return transformers[0].transform(x, y)
+
+
+def lonlat_to_dsm_pixel(dsm_transform, dsm_crs, lon, lat):
+    """Map lon/lat arrays to fractional DSM pixel coordinates (col, row)."""
+    transformers = lonlat_transformers(dsm_crs)
+    if transformers is not None:
+        lon, lat = transformers[1].transform(lon, lat)
+    return ~dsm_transform * (lon, lat)
+
+
+def read_dsm_crs(dsm_src):
+    """CRS of an open DSM as a WKT string (hashable and picklable), or None."""
+    return dsm_src.crs.to_wkt() if dsm_src.crs else None
+
+
+def valid_dsm_mask(dsm, dsm_nodata):
+    """Mask of DSM cells that carry a usable height (finite and not nodata)."""
+    mask = np.isfinite(dsm)
+    if dsm_nodata is not None:
+        with np.errstate(invalid="ignore"):
+            mask &= ~(np.abs(dsm - dsm_nodata) < 1e-4)
+    return mask
+
+
+def project_dsm_chunk(rpc, dsm_transform, rows, cols, heights, img_width, img_height, dsm_crs=None):
+    """
+    Project a batch of DSM cells into the image with one RPC call.
+
+    Returns the image row/col (rounded like the per-pixel version) and heights of the
+    cells that land inside the image, in the same order as the input cells.
+    """
+    lon, lat = dsm_pixel_to_lonlat(dsm_transform, dsm_crs, cols + 0.5, rows + 0.5)
+    with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+        col_img, row_img = rpc.RPC_OBJ2PHOTO(lat, lon, heights.astype(np.float64))
+        col_img = np.rint(np.asarray(col_img, dtype=np.float64))
+        row_img = np.rint(np.asarray(row_img, dtype=np.float64))
+        inside = (np.isfinite(col_img) & np.isfinite(row_img) &
+                  (col_img >= 0) & (col_img < img_width) &
+                  (row_img >= 0) & (row_img < img_height))
+    return row_img[inside].astype(np.int64), col_img[inside].astype(np.int64), heights[inside]
+
+
+def scatter_last_wins(height_map, row_img, col_img, heights):
+    """Write heights into the map; for repeated pixels the last cell wins, as in the loop version."""
+    flat = row_img * height_map.shape[1] + col_img
+    _, last_rev = np.unique(flat[::-1], return_index=True)
+    keep = flat.size - 1 - last_rev
+    height_map.reshape(-1)[flat[keep]] = heights[keep]
+
+
+def scatter_zbuffer(height_map, row_img, col_img, heights):
+    """
+    Z-buffer scatter: keep the highest height per pixel.
+
+    Cells that land on the same pixel lie on (nearly) the same viewing ray, and the
+    highest of them is the one closest to the sensor, i.e. the visible surface. The
+    nodata value (-9999) is below any real height, so it never wins the max.
+    """
+    flat = row_img * height_map.shape[1] + col_img
+    if flat.size == 0:
+        return
+    order = np.lexsort((heights, flat))
+    flat, heights = flat[order], heights[order]
+    # 排序后每个像素的最后一个即为该批次内的最高点
+    is_last = np.append(flat[1:] != flat[:-1], True)
+    flat, heights = flat[is_last], heights[is_last]
+    flat_map = height_map.reshape(-1)
+    flat_map[flat] = np.maximum(flat_map[flat], heights)
+
+
+def project_dsm_to_image(dsm, dsm_transform, dsm_nodata, rpc, img_width, img_height,
+                         chunk_size=DEFAULT_CHUNK_SIZE, mode="last", height_map=None, dsm_crs=None,
+                         stats=None):
+    """
+    Batched forward projection of a DSM into image space.
+
+    The DSM is walked in row bands of about `chunk_size` cells (row-major, same order as
+    the original double loop), each band is projected with a single RPC call and scattered
+    into the height map with array indexing. `mode` selects how pixels hit by several
+    cells are resolved (see PROJECTION_MODES).
+
+    If `height_map` is given (e.g. a memmap) the projection is accumulated into it instead
+    of a fresh array, which lets a DSM be fed window by window. `dsm_crs` (WKT) is only
+    needed for projected DSMs; geographic DSMs use the transform output as lon/lat.
+
+    If a `stats` dict is given, the number of projected cells and of cells that landed
+    outside the image are added to its "projected_cells" / "outside_cells" counters.
+    """
+    if mode not in PROJECTION_MODES:
+        raise ValueError(f"Unknown projection mode: {mode} (expected one of {PROJECTION_MODES})")
+    scatter = scatter_zbuffer if mode == "zbuffer" else scatter_last_wins
+
+    rows, cols = dsm.shape
+    if height_map is None:
+        height_map = np.full((img_height, img_width), -9999, dtype=np.float32)
+    band_rows = max(1, chunk_size // max(cols, 1))
+
+    for top in range(0, rows, band_rows):
+        band = dsm[top:top + band_rows]
+        band_r, band_c = np.nonzero(valid_dsm_mask(band, dsm_nodata))
+        if band_r.size == 0:
+            continue
+        heights = band[band_r, band_c]
+        row_img, col_img, heights = project_dsm_chunk(
+            rpc, dsm_transform, band_r + top, band_c, heights, img_width, img_height, dsm_crs=dsm_crs)
+        scatter(height_map, row_img, col_img, heights)
+        if stats is not None:
+            stats["projected_cells"] = stats.get("projected_cells", 0) + int(band_r.size)
+            stats["outside_cells"] = stats.get("outside_cells", 0) + int(band_r.size - heights.size)
+
+    return height_map
+
+
+def sample_dsm_nearest(dsm, dsm_transform, dsm_nodata, lon, lat, dsm_crs=None):
+    """Nearest-cell DSM lookup for arrays of lon/lat; NaN where outside the DSM or nodata."""
+    col_f, row_f = lonlat_to_dsm_pixel(dsm_transform, dsm_crs, lon, lat)
+    with np.errstate(invalid="ignore"):
+        col = np.floor(col_f)
+        row = np.floor(row_f)
+        inside = (np.isfinite(col) & np.isfinite(row) &
+                  (col >= 0) & (col < dsm.shape[1]) & (row >= 0) & (row < dsm.shape[0]))
+    heights = np.full(lon.shape, np.nan, dtype=np.float64)
+    heights[inside] = dsm[row[inside].astype(np.int64), col[inside].astype(np.int64)]
+    heights[~np.isfinite(heights)] = np.nan
+    if dsm_nodata is not None:
+        heights[np.abs(heights - dsm_nodata) < 1e-4] = np.nan
+    return heights
+
+
+def inverse_project_image_to_dsm(dsm, dsm_transform, dsm_nodata, rpc, img_width, img_height,
+                                 chunk_size=DEFAULT_CHUNK_SIZE, max_iter=INVERSE_MAX_ITER,
+                                 tolerance=INVERSE_TOLERANCE, dsm_crs=None):
+    """
+    Image-driven (inverse) heightmap generation.
+
+    For every image pixel the viewing ray is intersected with the DSM surface by the
+    fixed-point iteration h <- DSM(RPC_PHOTO2OBJ(col, row, h)), run for all pixels of a
+    chunk at once. Every pixel whose ray converges on valid DSM gets a height, so there
+    are no splatting holes when the image GSD is finer than the DSM GSD.
+
+    Pixels that do not settle within `max_iter` (typically rays grazing a facade, where the
+    iteration oscillates between two surfaces) have no reliable height and are written as
+    nodata; the returned count tells how many there were.
+    """
+    height_map = np.full((img_height, img_width), -9999, dtype=np.float32)
+    valid = valid_dsm_mask(dsm, dsm_nodata)
+    h_start = float(np.median(dsm[valid])) if valid.any() else 0.0
+    n_unconverged = 0
+
+    band_rows = max(1, chunk_size // max(img_width, 1))
+    for top in range(0, img_height, band_rows):
+        bottom = min(top + band_rows, img_height)
+        rows, cols = np.mgrid[top:bottom, 0:img_width]
+        rows = rows.ravel().astype(np.float64)
+        cols = cols.ravel().astype(np.float64)
+
+        h = np.full(rows.shape, h_start, dtype=np.float64)
+        active = np.ones(rows.shape, dtype=bool)
+        with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+            for _ in range(max_iter):
+                idx = np.nonzero(active)[0]
+                if idx.size == 0:
+                    break
+                lat, lon = rpc.RPC_PHOTO2OBJ(cols[idx], rows[idx], h[idx])
+                h_new = sample_dsm_nearest(dsm, dsm_transform, dsm_nodata,
+                                           np.asarray(lon, dtype=np.float64),
+                                           np.asarray(lat, dtype=np.float64), dsm_crs=dsm_crs)
+                # 射线落在 DSM 外或无效值处：该像素无解
+                lost = ~np.isfinite(h_new)
+                h[idx[lost]] = np.nan
+                active[idx[lost]] = False
+
+                keep = ~lost
+                settled = np.abs(h_new[keep] - h[idx[keep]]) < tolerance
+                h[idx[keep]] = h_new[keep]
+                active[idx[keep][settled]] = False
+
+        # 迭代未收敛的像素不写入（最后一次采样并不一定是射线与地表的交点）
+        n_unconverged += int(active.sum())
+        h[active] = np.nan
+        ok = np.isfinite(h)
+        height_map[rows[ok].astype(np.int64), cols[ok].astype(np.int64)] = h[ok]
+
+    return height_map, n_unconverged
+
+
+def image_footprint_dsm_window(rpc, img_width, img_height, dsm_transform, dsm_shape, h_min, h_max,
+                               margin=FOOTPRINT_MARGIN, n_edge=9, dsm_crs=None):
+    """
+    DSM window (row0, row1, col0, col1) that can project into the image.
+
+    Points along the image border are intersected with the planes h_min and h_max via
+    RPC_PHOTO2OBJ; their bounding box in DSM pixel space, grown by `margin` cells, bounds
+    every DSM cell whose height lies in [h_min, h_max] and lands inside the image.
+    Returns None when the footprint cannot be computed (the caller then keeps the full DSM).
+    """
+    t = np.linspace(0.0, 1.0, n_edge)
+    edge_samp = np.concatenate([t * img_width, np.full(n_edge, float(img_width)),
+                                t * img_width, np.zeros(n_edge)]) - 0.5
+    edge_line = np.concatenate([np.zeros(n_edge), t * img_height,
+                                np.full(n_edge, float(img_height)), t * img_height]) - 0.5
+    samp = np.tile(edge_samp, 2)
+    line = np.tile(edge_line, 2)
+    hei = np.repeat([float(h_min), float(h_max)], edge_samp.size)
+
+    with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+        lat, lon = rpc.RPC_PHOTO2OBJ(samp, line, hei)
+        col_f, row_f = lonlat_to_dsm_pixel(dsm_transform, dsm_crs, np.asarray(lon, dtype=np.float64),
+                                           np.asarray(lat, dtype=np.float64))
+    ok = np.isfinite(col_f) & np.isfinite(row_f)
+    if not ok.all():
+        return None
+
+    rows, cols = dsm_shape
+    row0 = int(np.clip(np.floor(row_f.min()) - margin, 0, rows))
+    row1 = int(np.clip(np.ceil(row_f.max()) + margin, 0, rows))
+    col0 = int(np.clip(np.floor(col_f.min()) - margin, 0, cols))
+    col1 = int(np.clip(np.ceil(col_f.max()) + margin, 0, cols))
+    return row0, row1, col0, col1
+
+
+def cull_dsm_to_image(dsm, dsm_transform, dsm_nodata, rpc, img_width, img_height, margin=FOOTPRINT_MARGIN,
+                      dsm_crs=None):
+    """
+    Restrict a DSM to the window that can actually hit the image.
+
+    Returns the sub-array, its transform and the number of DSM cells skipped.
+    """
+    valid = valid_dsm_mask(dsm, dsm_nodata)
+    if not valid.any():
+        return dsm[:0, :0], dsm_transform, int(dsm.size)
+    heights = dsm[valid]
+    bounds = image_footprint_dsm_window(rpc, img_width, img_height, dsm_transform, dsm.shape,
+                                        heights.min(), heights.max(), margin=margin, dsm_crs=dsm_crs)
+    if bounds is None:
+        return dsm, dsm_transform, 0
+
+    row0, row1, col0, col1 = bounds
+    row1, col1 = max(row0, row1), max(col0, col1)
+    sub_dsm = dsm[row0:row1, col0:col1]
+    sub_transform = window_transform(Window(col0, row0, col1 - col0, row1 - row0), dsm_transform)
+    return sub_dsm, sub_transform, int(dsm.size - sub_dsm.size)
+
+
+def dsm_height_range(dsm_src):
+    """
+    Valid height range (h_min, h_max) of an open DSM without a full-resolution read.
+
+    Uses the band statistics stored in the file if present, otherwise one decimated read
+    (served from the overviews when the file has them), widened by HEIGHT_RANGE_PAD of
+    the span since a preview can miss the extremes. Returns None if nothing valid is seen.
+    """
+    tags = dsm_src.tags(1)
+    if "STATISTICS_MINIMUM" in tags and "STATISTICS_MAXIMUM" in tags:
+        return float(tags["STATISTICS_MINIMUM"]), float(tags["STATISTICS_MAXIMUM"])
+    factor = max(1, int(np.ceil(max(dsm_src.height, dsm_src.width) / HEIGHT_RANGE_PREVIEW_SIZE)))
+    preview = dsm_src.read(1, out_shape=(max(1, dsm_src.height // factor), max(1, dsm_src.width // factor)))
+    valid = valid_dsm_mask(preview, dsm_src.nodata)
+    if not valid.any():
+        return None
+    h_min, h_max = float(preview[valid].min()), float(preview[valid].max())
+    pad = (h_max - h_min) * HEIGHT_RANGE_PAD if factor > 1 else 0.0
+    return h_min - pad, h_max + pad
+
+
+def intersect_window(window, bounds):
+    """Part of a DSM window inside (row0, row1, col0, col1), or None if they do not overlap."""
+    row0, row1, col0, col1 = bounds
+    r0, r1 = max(int(window.row_off), row0), min(int(window.row_off + window.height), row1)
+    c0, c1 = max(int(window.col_off), col0), min(int(window.col_off + window.width), col1)
+    if r1 <= r0 or c1 <= c0:
+        return None
+    return Window(c0, r0, c1 - c0, r1 - r0)
+
+
+def load_image_rpc(image_path):
+    with rasterio.open(image_path) as img_src:
+        img_width, img_height = img_src.width, img_src.height
+        img_profile = img_src.profile
+    rpc_file = find_rpc_file(image_path)
+    rpc = RPCModelParameter()
+    rpc.load_dirpc_from_file(rpc_file)
+    return rpc, img_width, img_height, img_profile
+
+
+# ---------------- 多分辨率金字塔：由内存中的全分辨率结果直接降采样，省去额外读写 ----------------
+
+def pyramid_level_path(output_path, factor):
+    base, ext = os.path.splitext(output_path)
+    return f"{base}_d{factor}{ext}"
+
+
+def reduce_height_map(height_map, factor, method="mean", nodata=-9999):
+    """Nodata-aware factor x factor block reduction (min / max / mean over valid pixels)."""
+    rows, cols = height_map.shape
+    out_rows, out_cols = -(-rows // factor), -(-cols // factor)
+    padded = np.full((out_rows * factor, out_cols * factor), np.nan, dtype=np.float32)
+    padded[:rows, :cols] = height_map
+    padded[padded == nodata] = np.nan
+    blocks = padded.reshape(out_rows, factor, out_cols, factor)
+
+    reducer = {"min": np.nanmin, "max": np.nanmax, "mean": np.nanmean}[method]
+    with warnings.catch_warnings():
+        # 全为无效值的块会触发 "All-NaN slice" 警告，结果置为 nodata 即可
+        warnings.simplefilter("ignore", RuntimeWarning)
+        reduced = reducer(blocks, axis=(1, 3))
+    reduced[~np.isfinite(reduced)] = nodata
+    return reduced.astype(np.float32)
+
+
+def write_height_map_pyramid(height_map, img_profile, output_path, levels, method="mean",
+                             chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Write levels 1..`levels` of the height-map pyramid as sibling files.
+
+    Works strip by strip (strip height a multiple of the level factor), so it can be fed
+    the in-memory result as well as the memmap used by the streaming mode.
+    """
+    if method not in PYRAMID_METHODS:
+        raise ValueError(f"Unknown pyramid method: {method} (expected one of {PYRAMID_METHODS})")
+    img_height, img_width = height_map.shape
+    level_paths = []
+    for level in range(1, levels + 1):
+        factor = 2 ** level
+        out_height, out_width = -(-img_height // factor), -(-img_width // factor)
+        profile = img_profile.copy()
+        for key in ("blockxsize", "blockysize", "tiled"):
+            profile.pop(key, None)
+        profile.update(width=out_width, height=out_height, dtype=rasterio.float32, count=1, nodata=-9999)
+        if profile.get("transform") is not None:
+            profile["transform"] = profile["transform"] * profile["transform"].scale(factor)
+
+        strip_rows = max(1, chunk_size // max(img_width, 1) // factor) * factor
+        level_path = pyramid_level_path(output_path, factor)
+        with rasterio.open(level_path, "w", **profile) as dst:
+            for top in range(0, img_height, strip_rows):
+                reduced = reduce_height_map(np.asarray(height_map[top:top + strip_rows]), factor, method)
+                dst.write(reduced, 1, window=Window(0, top // factor, out_width, reduced.shape[0]))
+        level_paths.append(level_path)
+    return level_paths
+
+
+# ---------------- 统计信息 sidecar：生成时顺带记录，下游无需重新读取整幅高度图 ----------------
 
-def dsm_to_image_projection_single(args):
+def height_map_stats_path(output_path):
+    return os.path.splitext(output_path)[0] + ".json"
+
+
+def compute_height_map_stats(height_map, nodata=-9999):
+    """Fill ratio, height range and percentiles of the valid pixels of a height map."""
+    values = np.asarray(height_map)
+    values = values[(values != nodata) & np.isfinite(values)]
+    stats = {
+        "width": int(height_map.shape[1]),
+        "height": int(height_map.shape[0]),
+        "fill_ratio": float(values.size) / height_map.size if height_map.size else 0.0,
+        "min": float(values.min()) if values.size else None,
+        "max": float(values.max()) if values.size else None,
+    }
+    percentiles = np.percentile(values, STATS_PERCENTILES) if values.size else [None] * len(STATS_PERCENTILES)
+    for q, v in zip(STATS_PERCENTILES, percentiles):
+        stats[f"p{q}"] = float(v) if v is not None else None
+    return stats
+
+
+def write_height_map_stats(output_path, stats):
+    with open(height_map_stats_path(output_path), "w") as f:
+        json.dump(stats, f, indent=2)
+
+
+def read_height_map_stats(output_path):
+    """Load the sidecar written next to a height map (pass the heightmap .tif path); None if missing."""
+    stats_path = height_map_stats_path(output_path)
+    if not os.path.exists(stats_path):
+        return None
+    with open(stats_path, "r") as f:
+        return json.load(f)
+
+
+def generate_height_map(dsm, dsm_transform, dsm_nodata, image_path, output_path,
+                        chunk_size=DEFAULT_CHUNK_SIZE, mode="last", approx_max_error=DEFAULT_APPROX_MAX_ERROR,
+                        footprint_cull=True, dsm_crs=None, pyramid_levels=0, pyramid_method="mean",
+                        write_stats=True):
+    """
+    Generate and save one height map; returns a dict of per-image statistics, which is
+    also written as a JSON sidecar next to the output when write_stats is set.
+    """
+    t_start = time.perf_counter()
+    rpc, img_width, img_height, img_profile = load_image_rpc(image_path)
+    stats = {"mode": mode, "skipped_cells": 0, "projected_cells": 0, "outside_cells": 0}
+
+    if mode != "inverse":
+        if footprint_cull:
+            dsm, dsm_transform, stats["skipped_cells"] = cull_dsm_to_image(
+                dsm, dsm_transform, dsm_nodata, rpc, img_width, img_height, dsm_crs=dsm_crs)
+        if approx_max_error is not None and dsm.size:
+            rpc = make_approx_projector(rpc, dsm, dsm_transform, dsm_nodata, max_error=approx_max_error,
+                                        to_lonlat=partial(dsm_pixel_to_lonlat, dsm_transform, dsm_crs))
+
+    t_project = time.perf_counter()
+    if mode == "inverse":
+        height_map, stats["unconverged_pixels"] = inverse_project_image_to_dsm(
+            dsm, dsm_transform, dsm_nodata, rpc, img_width, img_height, chunk_size=chunk_size,
+            dsm_crs=dsm_crs)
+    else:
+        height_map = project_dsm_to_image(dsm, dsm_transform, dsm_nodata, rpc,
+                                          img_width, img_height, chunk_size=chunk_size, mode=mode,
+                                          dsm_crs=dsm_crs, stats=stats)
+    stats["projection_s"] = time.perf_counter() - t_project
+
+    img_profile.update(dtype=rasterio.float32, count=1, nodata=-9999)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with rasterio.open(output_path, "w", **img_profile) as dst:
+        dst.write(height_map, 1)
+    if pyramid_levels:
+        write_height_map_pyramid(height_map, img_profile, output_path, pyramid_levels,
+                                 method=pyramid_method, chunk_size=chunk_size)
+
+    stats.update(compute_height_map_stats(height_map))
+    stats["total_s"] = time.perf_counter() - t_start
+    if write_stats:
+        write_height_map_stats(output_path, stats)
+    return stats
+
+
+def dsm_to_image_projection_single(args, **options):
+    """Worker: read the DSM from disk and generate one height map (options go to generate_height_map)."""
     dsm_path, image_path, output_path = args
     try:
         with rasterio.open(dsm_path) as dsm_src:
             dsm = dsm_src.read(1)
             dsm_transform = dsm_src.transform
             dsm_nodata = dsm_src.nodata  # 👈 读取无效值
-            rows, cols = dsm.shape
+            dsm_crs = read_dsm_crs(dsm_src)
 
-        with rasterio.open(image_path) as img_src:
-            img_width, img_height = img_src.width, img_src.height
-            img_profile = img_src.profile
-            rpc_file = image_path.replace(".tif", ".rpc")
-            rpc = RPCModelParameter()
-            rpc.load_dirpc_from_file(rpc_file)
+        stats = generate_height_map(dsm, dsm_transform, dsm_nodata, image_path, output_path,
+                                    dsm_crs=dsm_crs, **options)
+        return (f"[✓] Saved: {output_path} (fill {stats['fill_ratio']:.1%}, "
+                f"skipped {stats['skipped_cells']} DSM cells outside footprint)")
+    except Exception as e:
+        return f"[✗] Failed: {image_path} - {e}"
 
-        height_map = np.full((img_height, img_width), -9999, dtype=np.float32)
 
-        for row_dsm in range(rows):
-            for col_dsm in range(cols):
-                h = dsm[row_dsm, col_dsm]
+# ---------------- 流式处理：按 DSM 块窗口读取，输出落盘，内存占用与 DSM 大小无关 ----------------
 
-                # 👇 增加健壮的无效值检查
-                if (not np.isfinite(h)) or (dsm_nodata is not None and abs(h - dsm_nodata) < 1e-4):
-                    continue
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process in MB (None if it cannot be read).
+    Unlike tracemalloc this includes the GDAL block cache, read buffers and resident
+    memmap pages. In a pool worker it is the high-water mark over all tasks so far.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024  # macOS: 字节，Linux: KB
+    try:
+        import psutil
+    except ImportError:
+        return None
+    mem = psutil.Process().memory_info()
+    return getattr(mem, "peak_wset", mem.rss) / 2**20
 
-                lon, lat = dsm_transform * (col_dsm + 0.5, row_dsm + 0.5)
-                try:
-                    col_img, row_img = rpc.RPC_OBJ2PHOTO(lat, lon, h)
-                    col_img = int(round(col_img[0]))
-                    row_img = int(round(row_img[0]))
-                    if 0 <= col_img < img_width and 0 <= row_img < img_height:
-                        height_map[row_img, col_img] = h
-                except:
-                    continue
 
-        img_profile.update(dtype=rasterio.float32, count=1, nodata=-9999)
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        with rasterio.open(output_path, "w", **img_profile) as dst:
-            dst.write(height_map, 1)
+def dsm_to_image_projection_streaming(args, chunk_size=DEFAULT_CHUNK_SIZE, mode="zbuffer",
+                                      approx_max_error=DEFAULT_APPROX_MAX_ERROR, footprint_cull=True,
+                                      pyramid_levels=0, pyramid_method="mean", write_stats=True,
+                                      gdal_cachemax_mb=STREAMING_GDAL_CACHEMAX_MB):
+    """
+    Forward projection for DSMs too large to hold in memory.
+
+    The DSM is read one internal block window at a time and each window is projected
+    into a memory-mapped scratch height map, which is then written to the output raster
+    strip by strip. The GDAL block cache is capped at gdal_cachemax_mb, so memory depends
+    on the block and chunk size, not on the DSM size; the process peak RSS is reported
+    in the result message and the stats sidecar.
+
+    With footprint_cull the image footprint on the DSM is computed once from the DSM
+    height range (see dsm_height_range; pass it as a 4th task element to reuse one
+    estimate for all images of a DSM), and block windows outside it are skipped before
+    they are read. The approximate projector, if enabled, is built once over that extent.
+
+    Pixels hit by several cells are resolved per window, so "last" follows block order
+    rather than global row order; "zbuffer" (the default here) is order-independent.
+    """
+    dsm_path, image_path, output_path = args[:3]
+    h_range = args[3] if len(args) > 3 else None
+    scratch_path = output_path + ".scratch"
+    t_start = time.perf_counter()
+    try:
+        with rasterio.Env(GDAL_CACHEMAX=gdal_cachemax_mb):
+            rpc, img_width, img_height, img_profile = load_image_rpc(image_path)
+            stats = {"mode": mode, "streaming": True, "projected_cells": 0, "outside_cells": 0}
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            height_map = np.memmap(scratch_path, dtype=np.float32, mode="w+", shape=(img_height, img_width))
+            height_map[:] = -9999
+            skipped = 0
+
+            with rasterio.open(dsm_path) as dsm_src:
+                dsm_nodata = dsm_src.nodata
+                dsm_crs = read_dsm_crs(dsm_src)
+                dsm_transform = dsm_src.transform
+                bounds = (0, dsm_src.height, 0, dsm_src.width)
+                if h_range is None and (footprint_cull or approx_max_error is not None):
+                    h_range = dsm_height_range(dsm_src)
+
+                # 影像覆盖的 DSM 窗口每幅影像只算一次；不相交的块在读取（解码）之前就跳过
+                if footprint_cull and h_range is not None:
+                    footprint = image_footprint_dsm_window(rpc, img_width, img_height, dsm_transform,
+                                                           (dsm_src.height, dsm_src.width), *h_range,
+                                                           dsm_crs=dsm_crs)
+                    if footprint is not None:
+                        bounds = footprint
+
+                # 近似投影网格覆盖整个裁剪范围，只建一次（网格外的点由 ApproxRPCProjector 回退精确 RPC）
+                proj_rpc = rpc
+                row0, row1, col0, col1 = bounds
+                if approx_max_error is not None and h_range is not None and row1 > row0 and col1 > col0:
+                    lon, lat = dsm_pixel_to_lonlat(dsm_transform, dsm_crs,
+                                                   np.array([col0, col1, col0, col1], dtype=np.float64),
+                                                   np.array([row0, row0, row1, row1], dtype=np.float64))
+                    lon, lat = np.asarray(lon), np.asarray(lat)
+                    proj_rpc = ApproxRPCProjector(rpc, (lon.min(), lon.max()), (lat.min(), lat.max()), h_range,
+                                                  max_error=approx_max_error)
+
+                for _, block_window in dsm_src.block_windows(1):
+                    n_block = int(block_window.width * block_window.height)
+                    window = intersect_window(block_window, bounds)
+                    if window is None:
+                        skipped += n_block
+                        continue
+                    skipped += n_block - int(window.width * window.height)
+                    block = dsm_src.read(1, window=window)
+                    project_dsm_to_image(block, dsm_src.window_transform(window), dsm_nodata, proj_rpc,
+                                         img_width, img_height, chunk_size=chunk_size, mode=mode,
+                                         height_map=height_map, dsm_crs=dsm_crs, stats=stats)
+            stats["projection_s"] = time.perf_counter() - t_start
+
+            img_profile.update(dtype=rasterio.float32, count=1, nodata=-9999)
+            strip_rows = max(1, chunk_size // max(img_width, 1))
+            with rasterio.open(output_path, "w", **img_profile) as dst:
+                for top in range(0, img_height, strip_rows):
+                    n_rows = min(strip_rows, img_height - top)
+                    dst.write(np.asarray(height_map[top:top + n_rows]), 1,
+                              window=Window(0, top, img_width, n_rows))
+            if pyramid_levels:
+                write_height_map_pyramid(height_map, img_profile, output_path, pyramid_levels,
+                                         method=pyramid_method, chunk_size=chunk_size)
+            stats.update(compute_height_map_stats(height_map))
+            del height_map
+
+        peak = peak_rss_mb()
+        stats.update(skipped_cells=skipped, peak_rss_mb=peak, total_s=time.perf_counter() - t_start)
+        if write_stats:
+            write_height_map_stats(output_path, stats)
+        peak_text = f"{peak:.1f} MB" if peak is not None else "n/a"
+        return (f"[✓] Saved: {output_path} (peak RSS {peak_text}, "
+                f"skipped {skipped} DSM cells outside footprint)")
+    except Exception as e:
+        return f"[✗] Failed: {image_path} - {e}"
+    finally:
+        if os.path.exists(scratch_path):
+            try:
+                os.remove(scratch_path)
+            except OSError:
+                pass
+
+
+# ---------------- 共享内存 DSM：同一 DSM 只读一次，供所有 worker 零拷贝访问 ----------------
+
+def publish_dsm(dsm_path):
+    """
+    Read a DSM once and copy it into a named shared-memory block.
+
+    Returns the SharedMemory handle (the caller owns it and must close + unlink it) and a
+    small picklable descriptor that workers use to attach via attach_dsm().
+    """
+    with rasterio.open(dsm_path) as dsm_src:
+        dsm = dsm_src.read(1)
+        dsm_info = {
+            "path": dsm_path,
+            "shape": dsm.shape,
+            "dtype": dsm.dtype.str,
+            "transform": dsm_src.transform,
+            "nodata": dsm_src.nodata,
+            "crs": read_dsm_crs(dsm_src),
+        }
+
+    shm = shared_memory.SharedMemory(create=True, size=max(dsm.nbytes, 1))
+    np.ndarray(dsm.shape, dtype=dsm.dtype, buffer=shm.buf)[:] = dsm
+    dsm_info["shm_name"] = shm.name
+    return shm, dsm_info
 
-        return f"[✓] Saved: {output_path}"
+
+def attach_dsm(dsm_info):
+    """Attach to a published DSM without copying; close the returned handle when done."""
+    shm = shared_memory.SharedMemory(name=dsm_info["shm_name"])
+    dsm = np.ndarray(dsm_info["shape"], dtype=np.dtype(dsm_info["dtype"]), buffer=shm.buf)
+    return shm, dsm
+
+
+def dsm_to_image_projection_shared(args, **options):
+    """Worker: attach to a published DSM and generate one height map (options go to generate_height_map)."""
+    dsm_info, image_path, output_path = args
+    try:
+        shm, dsm = attach_dsm(dsm_info)
+        try:
+            stats = generate_height_map(dsm, dsm_info["transform"], dsm_info["nodata"], image_path, output_path,
+                                        dsm_crs=dsm_info["crs"], **options)
+        finally:
+            # 先释放数组视图，再关闭共享内存句柄
+            del dsm
+            shm.close()
+        return (f"[✓] Saved: {output_path} (fill {stats['fill_ratio']:.1%}, "
+                f"skipped {stats['skipped_cells']} DSM cells outside footprint)")
     except Exception as e:
         return f"[✗] Failed: {image_path} - {e}"
 
 
-def batch_generate_height_maps_parallel(dataset_root, max_workers=8):
+def group_tasks_by_dsm(tasks):
+    """Group (dsm_path, image_path, output_path) tasks by DSM, keeping first-seen DSM order."""
+    groups = OrderedDict()
+    for dsm_path, image_path, output_path in tasks:
+        groups.setdefault(dsm_path, []).append((image_path, output_path))
+    return groups
+
+
+def benchmark_projection_modes(dsm_path, image_path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Time the "last" and "zbuffer" modes on one DSM/image pair and report how much the
+    z-buffer output differs from the current (last-write-wins) output.
+    """
+    with rasterio.open(dsm_path) as dsm_src:
+        dsm = dsm_src.read(1)
+        dsm_transform = dsm_src.transform
+        dsm_nodata = dsm_src.nodata
+        dsm_crs = read_dsm_crs(dsm_src)
+    rpc, img_width, img_height, _ = load_image_rpc(image_path)
+
+    results, timings = {}, {}
+    for mode in PROJECTION_MODES:
+        t0 = time.perf_counter()
+        results[mode] = project_dsm_to_image(dsm, dsm_transform, dsm_nodata, rpc,
+                                             img_width, img_height, chunk_size=chunk_size, mode=mode,
+                                             dsm_crs=dsm_crs)
+        timings[mode] = time.perf_counter() - t0
+
+    last, zbuf = results["last"], results["zbuffer"]
+    filled = last != -9999
+    changed = filled & (last != zbuf)
+    n_filled = int(filled.sum())
+    report = {
+        "timings_s": timings,
+        "filled_pixels": n_filled,
+        "changed_pixels": int(changed.sum()),
+        "changed_ratio": float(changed.sum()) / n_filled if n_filled else 0.0,
+        "mean_abs_diff": float(np.abs(zbuf[changed] - last[changed]).mean()) if changed.any() else 0.0,
+        "max_abs_diff": float(np.abs(zbuf[changed] - last[changed]).max()) if changed.any() else 0.0,
+    }
+    print(f"⏱ last: {timings['last']:.2f}s, zbuffer: {timings['zbuffer']:.2f}s")
+    print(f"📊 {report['changed_pixels']}/{n_filled} pixels changed "
+          f"({report['changed_ratio']:.2%}), mean |Δh| = {report['mean_abs_diff']:.2f} m, "
+          f"max |Δh| = {report['max_abs_diff']:.2f} m")
+    return report
+
+
+def find_height_map_tasks(dataset_root):
+    """Collect (dsm_path, image_path, output_path) tasks for every image that has a block DSM."""
     image_paths = glob.glob(os.path.join(dataset_root, "*", "image", "*.tif"))
     tasks = []
 
@@ -72,13 +750,153 @@ def batch_generate_height_maps_parallel(dataset_root, max_workers=8):
 
         tasks.append((dsm_path, image_path, output_path))
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        for result in tqdm(executor.map(dsm_to_image_projection_single, tasks), total=len(tasks), desc="Generating"):
-            print(result)
+    return tasks
+
+
+def find_mvs3d_height_map_tasks(output_root, dsm_tile_dir):
+    """
+    Tasks for the MVS3D layout written by S3_Block_Images.py: `output_root/<tile>/image/*.tif`
+    with RPCs in `output_root/<tile>/rpc`, and the UTM DSM tile `dsm_tile_dir/<tile>.tif`.
+    The UTM tile is used directly (no warp to WGS84).
+    """
+    tasks = []
+    for image_path in glob.glob(os.path.join(output_root, "*", "image", "*.tif")):
+        block_dir = os.path.abspath(os.path.join(os.path.dirname(image_path), ".."))
+        tile_name = os.path.basename(block_dir)
+        base_name = os.path.splitext(os.path.basename(image_path))[0]
+        dsm_path = os.path.join(dsm_tile_dir, f"{tile_name}.tif")
+        output_path = os.path.join(block_dir, "heightmap", f"{base_name}_heightmap.tif")
+
+        if not os.path.exists(dsm_path):
+            continue
+
+        tasks.append((dsm_path, image_path, output_path))
+
+    return tasks
+
+
+def batch_generate_height_maps_parallel(dataset_root, max_workers=8, chunk_size=DEFAULT_CHUNK_SIZE, mode="last",
+                                        max_dsms_in_flight=2, streaming=False,
+                                        approx_max_error=DEFAULT_APPROX_MAX_ERROR, footprint_cull=True,
+                                        dsm_tile_dir=None, pyramid_levels=0, pyramid_method="mean",
+                                        write_stats=True):
+    """
+    Generate height maps for every image under dataset_root.
+
+    Tasks are grouped by block DSM and scheduled DSM-by-DSM: each DSM is decoded once in
+    the parent, published through shared memory, and released as soon as all of its
+    images are done. At most `max_dsms_in_flight` DSMs are resident at the same time.
+
+    With streaming=True (forward modes only) the DSM is never loaded whole; each task
+    reads it window by window instead, see dsm_to_image_projection_streaming.
+
+    approx_max_error (pixels) switches the forward modes to the interpolated control-grid
+    projector from rpc_approx; None keeps exact RPC evaluation. footprint_cull restricts
+    the forward modes to the DSM window that can reach the image.
+
+    If dsm_tile_dir is given, dataset_root is read as an MVS3D output root (see
+    find_mvs3d_height_map_tasks); projected DSM CRSs such as UTM are handled natively.
+
+    pyramid_levels > 0 additionally writes 1/2, 1/4, ... resolution height maps next to each
+    output (see write_height_map_pyramid), reduced with pyramid_method (min/max/mean).
+
+    write_stats leaves a `<name>_heightmap.json` sidecar per image (fill ratio, height
+    range and percentiles, DSM cells outside the image, timing); read it back with
+    read_height_map_stats instead of re-opening the raster.
+    """
+    if mode not in GENERATION_MODES:
+        raise ValueError(f"Unknown generation mode: {mode} (expected one of {GENERATION_MODES})")
+    if dsm_tile_dir is not None:
+        tasks = find_mvs3d_height_map_tasks(dataset_root, dsm_tile_dir)
+    else:
+        tasks = find_height_map_tasks(dataset_root)
+
+    if streaming:
+        if mode not in PROJECTION_MODES:
+            raise ValueError(f"Streaming supports only {PROJECTION_MODES}, got: {mode}")
+        worker = partial(dsm_to_image_projection_streaming, chunk_size=chunk_size, mode=mode,
+                         approx_max_error=approx_max_error, footprint_cull=footprint_cull,
+                         pyramid_levels=pyramid_levels, pyramid_method=pyramid_method,
+                         write_stats=write_stats)
+        if footprint_cull or approx_max_error is not None:
+            # 每个 DSM 只估计一次高程范围，随任务传给 worker
+            h_ranges = {}
+            for dsm_path in group_tasks_by_dsm(tasks):
+                try:
+                    with rasterio.open(dsm_path) as dsm_src:
+                        h_ranges[dsm_path] = dsm_height_range(dsm_src)
+                except Exception:
+                    h_ranges[dsm_path] = None
+            tasks = [(dsm_path, image_path, output_path, h_ranges[dsm_path])
+                     for dsm_path, image_path, output_path in tasks]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for result in tqdm(executor.map(worker, tasks), total=len(tasks), desc="Generating (streaming)"):
+                print(result)
+        print("\n🎉 All height maps generated with streaming windows.\n")
+        return
+    dsm_groups = group_tasks_by_dsm(tasks)
+
+    worker = partial(dsm_to_image_projection_shared, chunk_size=chunk_size, mode=mode,
+                     approx_max_error=approx_max_error, footprint_cull=footprint_cull,
+                     pyramid_levels=pyramid_levels, pyramid_method=pyramid_method,
+                     write_stats=write_stats)
+    in_flight = deque()  # (shm, futures)
+
+    def free_shm(shm):
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def release_oldest():
+        shm, futures = in_flight.popleft()
+        try:
+            for future in futures:
+                print(future.result())
+                pbar.update(1)
+        finally:
+            free_shm(shm)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(total=len(tasks), desc="Generating") as pbar:
+        try:
+            for dsm_path, items in dsm_groups.items():
+                while len(in_flight) >= max(1, max_dsms_in_flight):
+                    wait(in_flight[0][1])
+                    release_oldest()
+
+                try:
+                    shm, dsm_info = publish_dsm(dsm_path)
+                except Exception as e:
+                    for image_path, _ in items:
+                        print(f"[✗] Failed: {image_path} - cannot load DSM {dsm_path}: {e}")
+                        pbar.update(1)
+                    continue
+
+                # 先登记再提交：submit 失败（如进程池已损坏）时该共享内存同样会被释放
+                futures = []
+                in_flight.append((shm, futures))
+                futures.extend(executor.submit(worker, (dsm_info, image_path, output_path))
+                               for image_path, output_path in items)
+
+            while in_flight:
+                release_oldest()
+        finally:
+            # 进程池损坏（BrokenProcessPool、worker 被 OOM 杀死）等异常退出时，
+            # 释放所有尚未回收的共享内存，避免残留在 /dev/shm 中
+            while in_flight:
+                free_shm(in_flight.popleft()[0])
 
-    print("\n🎉 All height maps generated with multiprocessing.\n")
+    print(f"\n🎉 All height maps generated with multiprocessing ({len(dsm_groups)} DSMs, each read once).\n")
 
 
 if __name__ == "__main__":
     dataset_root = r"H:\MVS-Dataset\Test2\OMA"
-    batch_generate_height_maps_parallel(dataset_root, max_workers=8)
+    # mode="zbuffer" 保留对传感器可见的最高点；benchmark_projection_modes 可对比两种模式
+    # mode="inverse" 由影像像素反向求交 DSM，避免正向投影的空洞（不收敛的像素记为无效值，见 json 中 unconverged_pixels）
+    # streaming=True 适用于整幅 Lidar 等大 DSM，按块窗口读取，结果中报告峰值内存
+    # approx_max_error=0.1 使用控制网格插值代替逐点精确 RPC（误差超限时自动回退）
+    # pyramid_levels=2 同时输出 1/2、1/4 分辨率高度图（*_heightmap_d2.tif / *_d4.tif）
+    # MVS3D：dataset_root 设为 S3_Block_Images.py 的 output_root，并传入 dsm_tile_dir（UTM 分块，无需转 WGS84）
+    batch_generate_height_maps_parallel(dataset_root, max_workers=8, chunk_size=DEFAULT_CHUNK_SIZE, mode="last")
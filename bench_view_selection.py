@@ -0,0 +1,432 @@
+# ------------------------------------------------------------------------------
+# File: bench_view_selection.py
+# Description: Synthetic scalability benchmark for the view-selection scripts.
+#              For every case (number of views n, group size k, azimuth layout,
+#              elevation range, date spread) a synthetic US3D tree and an MVS3D
+#              tree of empty .tif files plus generated .IMD files are written to a
+#              temporary directory. Each selector is then timed in isolation (on
+#              the in-memory image_infos) and end to end (whole folder walk, IMD
+#              store, JSON output), with tracemalloc peak memory and the number of
+#              enumerated / scored groups. Results are written as JSON so runs on
+#              different commits can be compared with compare_benchmarks().
+#              benchmark_find_all_valid_groups() and check_exact_searches() compare
+#              the fast selectors against plain exhaustive reference scans, and
+#              compare_beam_searches() reports the beam-search score gap.
+#              Runs fully offline; no imagery, RPC or DSM is needed.
+#
+# Usage:
+#   python bench_view_selection.py [output.json]
+#   compare_benchmarks("bench_old.json", "bench_new.json")
+# ------------------------------------------------------------------------------
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import itertools
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(REPO_ROOT, "US3D_pipeline"))
+sys.path.append(os.path.join(REPO_ROOT, "MVS3D_pipeline"))
+import Image_selected_sample as us3d_sample
+import Image_selected_best as us3d_best
+import img_select_best as mvs3d_best
+from geo_utils import compute_pair_matrices, GROUP_BATCH_SIZE
+
+DEFAULT_CASES = [
+    {"n": 10, "k": 3},
+    {"n": 20, "k": 3},
+    {"n": 20, "k": 5},
+    {"n": 30, "k": 5},
+    {"n": 40, "k": 5, "azimuth": "clustered"},
+]
+
+
+def synthetic_views(n, seed=0, azimuth="uniform", el_range=(50.0, 90.0), date_spread_days=60.0):
+    """
+    n random views: (datetime, sat az, sat el). azimuth="uniform" spreads the views over
+    0-360 deg, "clustered" draws them around 4 orbit directions (typical of repeat passes).
+    """
+    rng = random.Random(seed)
+    base = datetime(2015, 1, 1)
+    centers = [rng.uniform(0, 360) for _ in range(4)]
+    views = []
+    for _ in range(n):
+        if azimuth == "clustered":
+            az = (rng.choice(centers) + rng.gauss(0, 15)) % 360
+        else:
+            az = rng.uniform(0, 360)
+        views.append({
+            "datetime": base + timedelta(seconds=int(rng.uniform(0, date_spread_days * 86400))),
+            "az": az,
+            "el": rng.uniform(*el_range),
+        })
+    return views
+
+
+def write_imd(path, view):
+    with open(path, "w") as f:
+        f.write(f"\tfirstLineTime = {view['datetime']:%Y-%m-%dT%H:%M:%S}.000000Z;\n")
+        f.write(f"\tmeanSatAz = {view['az']:.4f};\n")
+        f.write(f"\tmeanSatEl = {view['el']:.4f};\n")
+        f.write("\tmeanSunAz = 150.0;\n\tmeanSunEl = 40.0;\n")
+        f.write(f"\tmeanOffNadirViewAngle = {90.0 - view['el']:.4f};\n\tmeanProductGSD = 0.31;\n")
+
+
+def make_synthetic_us3d(root, views, region="SYN", block=0):
+    """US3D layout: <root>/data/<region>_<block>/image/<region>_<block>_<id>_RGB.tif and <root>/meta/<region>/<id>.IMD"""
+    meta_dir = os.path.join(root, "meta", region)
+    image_dir = os.path.join(root, "data", f"{region}_{block:03d}", "image")
+    os.makedirs(meta_dir, exist_ok=True)
+    os.makedirs(image_dir, exist_ok=True)
+    for i, view in enumerate(views, 1):
+        write_imd(os.path.join(meta_dir, f"{i:02d}.IMD"), view)
+        open(os.path.join(image_dir, f"{region}_{block:03d}_{i:03d}_RGB.tif"), "wb").close()
+    return os.path.join(root, "data"), os.path.join(root, "meta")
+
+
+def make_synthetic_mvs3d(root, views):
+    """MVS3D layout: <root>/data/tile/image/<uid>.tif and a flat <root>/imd/<...>_<uid>_P1BS.IMD"""
+    imd_dir = os.path.join(root, "imd")
+    image_dir = os.path.join(root, "data", "tile", "image")
+    os.makedirs(imd_dir, exist_ok=True)
+    os.makedirs(image_dir, exist_ok=True)
+    for i, view in enumerate(views):
+        uid = f"{100000000000 + i:012d}_01_P{i % 1000:03d}"
+        write_imd(os.path.join(imd_dir, f"15JAN01-P1BS-{uid}.IMD"), view)
+        open(os.path.join(image_dir, f"{uid}.tif"), "wb").close()
+    return os.path.join(root, "data"), imd_dir
+
+
+def measure(fn, repeat=1):
+    """
+    Run fn() `repeat` times for the best wall time (stdout suppressed), then once more
+    under tracemalloc for the peak Python heap. Returns (result, seconds, peak_bytes).
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        with redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        with redirect_stdout(io.StringIO()):
+            fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, best, peak
+
+
+def us3d_image_infos(views):
+    return [{"image_path": f"SYN_000_{i:03d}_RGB.tif", "imd_path": None, **v} for i, v in enumerate(views, 1)]
+
+
+def run_case(case, seed=0, repeat=3, n_top=3):
+    """Benchmark all selectors on one synthetic case; returns a list of result dicts"""
+    n, k = case["n"], case["k"]
+    views = synthetic_views(n, seed=seed, azimuth=case.get("azimuth", "uniform"),
+                            el_range=tuple(case.get("el_range", (50.0, 90.0))),
+                            date_spread_days=case.get("date_spread_days", 60.0))
+    infos = us3d_image_infos(views)
+    n_combinations = math.comb(n, k)
+    rows = []
+
+    def record(name, scope, fn, groups_of, rep=repeat):
+        result, seconds, peak = measure(fn, rep)
+        row = {"selector": name, "scope": scope, "seconds": seconds, "peak_bytes": peak,
+               "combinations": n_combinations}
+        row.update(groups_of(result))
+        rows.append(row)
+        print(f"  {scope:9s} {name:40s} {seconds:9.4f}s  peak {peak / 2**20:8.2f} MiB  "
+              + ", ".join(f"{key}={val}" for key, val in groups_of(result).items()))
+
+    # --- isolation: selection core on in-memory image_infos ---
+    record("find_all_valid_groups", "isolation",
+           lambda: us3d_sample.find_all_valid_groups(infos, k=k),
+           lambda r: {"valid_groups": len(r)})
+    record("select_us3d_recommended_group", "isolation",
+           lambda: us3d_sample.select_us3d_recommended_group(infos, k=k),
+           lambda r: {"best_score": r[1]})
+    record("find_top_groups_bnb", "isolation",
+           lambda: us3d_best.find_top_groups_bnb(infos, k=k, n=n_top),
+           lambda r: {"scored_groups": r[1]["leaves"], "pruned": r[1]["pruned"],
+                      "best_score": r[0][0]["score"] if r[0] else None})
+    record("select_top_n_groups (mvs3d)", "isolation",
+           lambda: mvs3d_best.select_top_n_groups(infos, k=k, n=1),
+           lambda r: {"scored_groups": r[1]["leaves"], "pruned": r[1]["pruned"],
+                      "best_score": r[0][0][0] if r[0] else None})
+
+    # --- end to end: folder walk, IMD store, JSON output ---
+    with tempfile.TemporaryDirectory() as tmp:
+        data_root, meta_root = make_synthetic_us3d(os.path.join(tmp, "us3d"), views)
+        mvs_root, imd_root = make_synthetic_mvs3d(os.path.join(tmp, "mvs3d"), views)
+        record("process_all_best_group", "e2e",
+               lambda: us3d_best.process_all_best_group(data_root, meta_root, k=k, n=n_top),
+               lambda r: {"folders_ok": sum(x["status"] == "ok" for x in r)})
+        record("process_all_us3d_pairs_all_combinations", "e2e",
+               lambda: us3d_sample.process_all_us3d_pairs_all_combinations(data_root, meta_root, k=k),
+               lambda r: {"valid_groups": sum(x.get("valid_groups", 0) for x in r)})
+        record("process_all_image_folders (mvs3d)", "e2e",
+               lambda: mvs3d_best.process_all_image_folders(mvs_root, imd_root, k=k),
+               lambda r: {"folders_ok": sum(x["status"] == "ok" for x in r)})
+
+    for row in rows:
+        row.update({"case": case_key(case), "n": n, "k": k, "seed": seed})
+    return rows
+
+
+def find_all_valid_groups_exhaustive(image_infos, k=3, angle_range=(5, 45), max_incidence=40):
+    """Reference for Image_selected_sample.find_all_valid_groups: plain scan over all combinations"""
+    valid_groups = []
+    for group in itertools.combinations(image_infos, k):
+        passes = True
+        for i in range(k):
+            for j in range(i + 1, k):
+                valid, _, _ = us3d_sample.filter_and_score_pair(group[i], group[j], angle_range, max_incidence)
+                if not valid:
+                    passes = False
+                    break
+            if not passes:
+                break
+        if passes:
+            valid_groups.append(group)
+    return valid_groups
+
+
+def benchmark_find_all_valid_groups(view_counts=(10, 15, 20, 25, 30), k=5, seed=0):
+    """Time the exhaustive scan against the k-clique enumeration and check both return the same groups"""
+    results = []
+    for n in view_counts:
+        infos = us3d_image_infos(synthetic_views(n, seed=seed, el_range=(45.0, 90.0), date_spread_days=365.0))
+        t0 = time.perf_counter()
+        ref = find_all_valid_groups_exhaustive(infos, k=k)
+        t_ref = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        fast = us3d_sample.find_all_valid_groups(infos, k=k)
+        t_fast = time.perf_counter() - t0
+        same = [[id(x) for x in g] for g in ref] == [[id(x) for x in g] for g in fast]
+        results.append({"n": n, "k": k, "groups": len(fast), "exhaustive_s": t_ref,
+                        "clique_s": t_fast, "identical": same})
+        print(f"n={n:3d} k={k} groups={len(fast):7d}  exhaustive {t_ref:8.3f}s  "
+              f"clique {t_fast:8.3f}s  x{t_ref / max(t_fast, 1e-9):6.1f}  identical={same}")
+    return results
+
+
+def iter_index_combinations(n, k, batch_size=GROUP_BATCH_SIZE):
+    """Yield combinations(range(n), k) in order, as (m, k) index arrays"""
+    it = itertools.combinations(range(n), k)
+    while True:
+        block = list(itertools.islice(it, batch_size))
+        if not block:
+            return
+        yield np.array(block, dtype=np.int64)
+
+
+def score_groups_batch(groups, angle_mat, times_seconds, ideal_angle=20.0):
+    """
+    Batched Image_selected_best.score_group: groups is an (m, k) index array, pair values are
+    gathered from the precomputed matrices. Returns (score, time_span, avg_angle) arrays of length m.
+    """
+    k = groups.shape[1]
+    ii, jj = np.triu_indices(k, 1)
+    group_times = times_seconds[groups]
+    time_span = (group_times.max(axis=1) - group_times.min(axis=1)) / 86400.0
+    if len(ii) == 0:
+        zeros = np.zeros(len(groups))
+        return time_span, time_span, zeros
+    angles = angle_mat[groups[:, ii], groups[:, jj]]
+    avg_angle = angles.mean(axis=1)
+    angle_penalty = np.abs(angles - ideal_angle).mean(axis=1)
+    return time_span + angle_penalty, time_span, avg_angle
+
+
+def group_validity_batch(groups, valid_mat):
+    """Rows of the (m, k) index array whose pairs are all valid"""
+    k = groups.shape[1]
+    ii, jj = np.triu_indices(k, 1)
+    return valid_mat[groups[:, ii], groups[:, jj]].all(axis=1)
+
+
+def group_score_batch(groups, angle_mat, times_seconds, target_angle=20.0, target_time_span=3.0):
+    """
+    Batched img_select_best.group_score: gather pair angles of (m, k) index groups from the precomputed
+    matrix. Returns (scores, time_spans, angles) with angles of shape (m, k*(k-1)/2).
+    """
+    k = groups.shape[1]
+    ii, jj = np.triu_indices(k, 1)
+    group_times = times_seconds[groups]
+    time_span = (group_times.max(axis=1) - group_times.min(axis=1)) / 86400.0
+    angles = angle_mat[groups[:, ii], groups[:, jj]]
+    angle_penalty = np.abs(angles - target_angle).sum(axis=1)
+    time_penalty = np.abs(time_span - target_time_span)
+    return angle_penalty + time_penalty, time_span, angles
+
+
+def find_top_groups_exhaustive(image_infos, k=5, n=3, ideal_angle=20.0):
+    """Reference for Image_selected_best.find_top_groups_bnb: score all valid groups, sort, keep n"""
+    angle_mat, time_diff_mat, times_seconds = compute_pair_matrices(image_infos)
+    valid_mat = us3d_best.compute_pair_validity(image_infos, angle_mat, time_diff_mat)
+
+    all_valid_groups = []
+    for groups in iter_index_combinations(len(image_infos), k):
+        groups = groups[group_validity_batch(groups, valid_mat)]
+        if len(groups) == 0:
+            continue
+        scores, time_spans, avg_angles = score_groups_batch(groups, angle_mat, times_seconds, ideal_angle)
+        for idx, score, time_span, avg_angle in zip(groups, scores, time_spans, avg_angles):
+            all_valid_groups.append({
+                "images": [os.path.basename(image_infos[i]['image_path']) for i in idx],
+                "score": float(score),
+                "time_span": float(time_span),
+                "avg_angle": float(avg_angle)
+            })
+    return sorted(all_valid_groups, key=lambda x: x["score"])[:n], {"valid_groups": len(all_valid_groups)}
+
+
+def select_best_k_images_exhaustive(image_infos, k=3):
+    """Reference for img_select_best.select_top_n_groups (n=1): batched scan over all combinations"""
+    best_group, best_score = None, float("inf")
+    angle_mat, _, times_seconds = compute_pair_matrices(image_infos)
+    for groups in iter_index_combinations(len(image_infos), k):
+        scores, _, _ = group_score_batch(groups, angle_mat, times_seconds)
+        pos = int(np.argmin(scores))
+        if scores[pos] < best_score:
+            best_score = float(scores[pos])
+            best_group = tuple(int(i) for i in groups[pos])
+    return best_group, best_score
+
+
+def check_exact_searches(view_counts=(10, 15, 20), k=4, n=3, seed=0):
+    """Check that both branch-and-bound searches return the same groups as the exhaustive references"""
+    ok = True
+    for n_views in view_counts:
+        infos = us3d_image_infos(synthetic_views(n_views, seed=seed))
+        ref, _ = find_top_groups_exhaustive(infos, k=k, n=n)
+        bnb, _ = us3d_best.find_top_groups_bnb(infos, k=k, n=n)
+        us3d_same = [g["images"] for g in ref] == [g["images"] for g in bnb]
+        ref_group, ref_score = select_best_k_images_exhaustive(infos, k=k)
+        top, _ = mvs3d_best.select_top_n_groups(infos, k=k, n=1)
+        mvs3d_same = bool(top) and tuple(top[0][1]) == ref_group and abs(top[0][0] - ref_score) < 1e-6
+        ok &= us3d_same and mvs3d_same
+        print(f"n={n_views:3d} k={k}  us3d top-{n} identical={us3d_same}  mvs3d best identical={mvs3d_same}")
+    return ok
+
+
+def compare_beam_with_exact(image_infos, k=5, beam_width=us3d_best.DEFAULT_BEAM_WIDTH):
+    """Best score, group and runtime of the beam selectors vs. the exact searches (US3D and MVS3D scoring)"""
+    rows = []
+    for name, beam_fn, exact_fn, score_of, group_of in (
+            ("us3d", us3d_best.find_top_groups_beam, us3d_best.find_top_groups_bnb,
+             lambda g: g["score"], lambda g: g["images"]),
+            ("mvs3d", mvs3d_best.select_top_n_groups_beam, mvs3d_best.select_top_n_groups,
+             lambda g: g[0], lambda g: tuple(g[1]))):
+        t0 = time.perf_counter()
+        beam_top, _ = beam_fn(image_infos, k=k, n=1, beam_width=beam_width)
+        t_beam = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        exact_top, _ = exact_fn(image_infos, k=k, n=1)
+        t_exact = time.perf_counter() - t0
+
+        beam_score = score_of(beam_top[0]) if beam_top else None
+        exact_score = score_of(exact_top[0]) if exact_top else None
+        rows.append({
+            "selector": name,
+            "n_views": len(image_infos),
+            "beam_width": beam_width,
+            "beam_score": beam_score,
+            "exact_score": exact_score,
+            "score_gap": beam_score - exact_score if beam_score is not None and exact_score is not None else None,
+            "same_group": bool(beam_top and exact_top and group_of(beam_top[0]) == group_of(exact_top[0])),
+            "beam_seconds": t_beam,
+            "exact_seconds": t_exact,
+        })
+    return rows
+
+
+def compare_beam_searches(view_counts=(20, 30, 40), k=5, beam_width=us3d_best.DEFAULT_BEAM_WIDTH, seed=0):
+    """Print the beam-vs-exact score gap on synthetic blocks small enough for the exact searches"""
+    results = []
+    for n_views in view_counts:
+        infos = us3d_image_infos(synthetic_views(n_views, seed=seed))
+        for row in compare_beam_with_exact(infos, k=k, beam_width=beam_width):
+            results.append(row)
+            gap = f"{row['score_gap']:.3f}" if row["score_gap"] is not None else "n/a"
+            print(f"n={n_views:3d} k={k} {row['selector']:5s} beam gap {gap}  same={row['same_group']}  "
+                  f"{row['beam_seconds']:.3f}s vs {row['exact_seconds']:.3f}s")
+    return results
+
+
+def case_key(case):
+    return ",".join(f"{key}={case[key]}" for key in sorted(case))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(cases=DEFAULT_CASES, seed=0, repeat=3, output_path=None):
+    """Run all cases; optionally write {"meta": ..., "results": [...]} to output_path"""
+    results = []
+    for case in cases:
+        print(f"\n📐 case {case_key(case)}")
+        results.extend(run_case(case, seed=seed, repeat=repeat))
+    report = {
+        "meta": {
+            "git_revision": git_revision(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "seed": seed,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Benchmark results saved to: {output_path}")
+    return report
+
+
+def compare_benchmarks(old_path, new_path):
+    """Print the time / peak-memory ratio (new vs old) of every (case, scope, selector) in both files"""
+    with open(old_path) as f:
+        old = {(r["case"], r["scope"], r["selector"]): r for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    rows = []
+    for r in new:
+        o = old.get((r["case"], r["scope"], r["selector"]))
+        if o is None:
+            continue
+        speedup = o["seconds"] / max(r["seconds"], 1e-12)
+        mem_ratio = r["peak_bytes"] / max(o["peak_bytes"], 1)
+        rows.append({"case": r["case"], "scope": r["scope"], "selector": r["selector"],
+                     "speedup": speedup, "peak_ratio": mem_ratio})
+        print(f"{r['case']:30s} {r['scope']:9s} {r['selector']:40s} x{speedup:7.2f} time, "
+              f"{mem_ratio:6.2f} peak mem")
+    return rows
+
+
+if __name__ == "__main__":
+    output_path = sys.argv[1] if len(sys.argv) > 1 else "bench_view_selection.json"
+    run_benchmarks(output_path=output_path)
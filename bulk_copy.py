@@ -0,0 +1,197 @@
+# ------------------------------------------------------------------------------
+# File: bulk_copy.py
+# Description: Concurrent bulk copier for the organize stage.
+#              All (src, dst) pairs are planned up front, identical destinations
+#              are de-duplicated, destinations that are already complete (same size
+#              and mtime as the source) are skipped, and the remaining files are
+#              copied by a bounded thread pool. Copies use kernel-side transfer
+#              (os.copy_file_range, then os.sendfile) where available, so the data
+#              never passes through Python buffers; other platforms fall back to a
+#              large-buffer stream copy. Each file is written to "<dst>.part" and
+#              renamed when complete, so an interrupted run never leaves a partial
+#              file that looks complete. Progress is reported in bytes/s.
+#              Link modes (see link_files.py) keep the source mtime on cloned or
+#              copied destinations as well, so reruns skip them in every mode.
+#
+# Usage:
+#   pairs = [(src, dst), ...]
+#   bulk_copy(pairs, max_workers=8)
+#   bulk_copy(pairs, link_mode="hardlink", stats=LinkStats())   # also reports the bytes saved
+# ------------------------------------------------------------------------------
+
+import os
+import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tqdm import tqdm
+
+from link_files import materialize_file
+
+COPY_CHUNK = 64 * 1024 * 1024
+STREAM_BUFFER = 8 * 1024 * 1024
+
+
+def dedup_pairs(pairs):
+    """{dst: src} keeping the first source of every destination; conflicting sources are reported"""
+    plan = {}
+    for src, dst in pairs:
+        dst = os.path.abspath(dst)
+        old = plan.setdefault(dst, src)
+        if os.path.abspath(old) != os.path.abspath(src):
+            print(f"⚠️ Destination planned from two sources, keeping the first: {dst}")
+    return plan
+
+
+def is_complete(src_stat, dst):
+    """dst already holds a finished copy: same size and same mtime (copies keep the source mtime)"""
+    try:
+        st = os.stat(dst)
+    except OSError:
+        return False
+    return st.st_size == src_stat.st_size and int(st.st_mtime) == int(src_stat.st_mtime)
+
+
+def _kernel_copy(fsrc, fdst, size, progress):
+    """
+    Copy size bytes between two open files in the kernel; returns False if not supported.
+    On False nothing is left in fdst and the progress already reported has been taken back,
+    so the caller can restart with a stream copy.
+    """
+    for fn_name in ("copy_file_range", "sendfile"):
+        fn = getattr(os, fn_name, None)
+        if fn is None:
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                if fn_name == "copy_file_range":
+                    n = fn(fsrc.fileno(), fdst.fileno(), min(COPY_CHUNK, size - copied))
+                else:
+                    n = fn(fdst.fileno(), fsrc.fileno(), copied, min(COPY_CHUNK, size - copied))
+                if n == 0:
+                    break
+                copied += n
+                progress(n)
+            if copied >= size:
+                return True
+        except OSError:
+            pass
+        if copied:  # stopped half way: undo before the next method / the stream copy
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            progress(-copied)
+    return False
+
+
+def copy_file(src, dst, src_stat, progress=lambda n: None):
+    """Copy one file via <dst>.part, then keep the source timestamps on the finished file"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    part = dst + ".part"
+    with open(src, "rb") as fsrc, open(part, "wb") as fdst:
+        if not _kernel_copy(fsrc, fdst, src_stat.st_size, progress):
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            while True:
+                buf = fsrc.read(STREAM_BUFFER)
+                if not buf:
+                    break
+                fdst.write(buf)
+                progress(len(buf))
+    shutil.copymode(src, part)
+    os.utime(part, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    os.replace(part, dst)
+
+
+def bulk_copy(pairs, max_workers=8, link_mode="copy", max_in_flight=None, stats=None):
+    """
+    Copy (or link, see link_files.LINK_MODES) all planned (src, dst) pairs concurrently.
+
+    Returns a report dict: planned / duplicate / skipped / copied / failed counts,
+    bytes of the completed transfers, seconds and bytes per second. With a
+    link_files.LinkStats as stats, the method used per file is recorded, reported
+    at the end and the bytes saved are added to the report.
+    """
+    pairs = list(pairs)
+    plan = dedup_pairs(pairs)
+    max_in_flight = max_in_flight or max_workers * 4
+
+    todo, skipped, failed = [], 0, []
+    for dst, src in plan.items():
+        try:
+            st = os.stat(src)
+        except OSError as e:
+            failed.append((src, dst, str(e)))
+            continue
+        if is_complete(st, dst):
+            skipped += 1
+            continue
+        todo.append((src, dst, st))
+    total_bytes = sum(st.st_size for _, _, st in todo)
+    print(f"📦 Planned {len(pairs)} files: {len(pairs) - len(plan)} duplicates, {skipped} already complete, "
+          f"{len(todo)} to transfer ({total_bytes / 2**30:.2f} GiB) with {max_workers} threads")
+
+    copied = done_bytes = 0
+    t0 = time.perf_counter()
+    with tqdm(total=total_bytes, unit="B", unit_scale=True, unit_divisor=1024, desc="Copying") as bar:
+        def job(src, dst, st):
+            """Transfer one file; returns the bytes it completed"""
+            if link_mode != "copy":
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                method = materialize_file(src, dst, link_mode, stats)
+                if method in ("copy", "reflink"):
+                    # 克隆 / 复制得到新的 mtime，保留源时间戳，重跑时 is_complete 才能跳过
+                    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+                bar.update(st.st_size)
+                return st.st_size
+            transferred = [0]
+
+            def progress(n):
+                transferred[0] += n
+                bar.update(n)
+
+            copy_file(src, dst, st, progress)
+            if stats is not None:
+                stats.add("copy", st.st_size)
+            return transferred[0]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+            items = iter(todo)
+            while True:
+                # 保持最多 max_in_flight 个任务在队列中，避免一次性为几十万文件创建 future
+                for src, dst, st in items:
+                    pending[executor.submit(job, src, dst, st)] = (src, dst)
+                    if len(pending) >= max_in_flight:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    src, dst = pending.pop(fut)
+                    try:
+                        done_bytes += fut.result()
+                        copied += 1
+                    except Exception as e:
+                        failed.append((src, dst, str(e)))
+
+    seconds = time.perf_counter() - t0
+    report = {
+        "planned": len(pairs),
+        "duplicates": len(pairs) - len(plan),
+        "skipped": skipped,
+        "copied": copied,
+        "failed": len(failed),
+        "bytes": done_bytes,
+        "seconds": seconds,
+        "bytes_per_second": done_bytes / seconds if seconds > 0 else 0.0,
+    }
+    print(f"✅ Transferred {report['copied']} files, {done_bytes / 2**20:.1f} MiB in {seconds:.1f}s "
+          f"({report['bytes_per_second'] / 2**20:.1f} MiB/s), skipped {skipped}, failed {len(failed)}")
+    for src, dst, err in failed:
+        print(f"  ❌ {src} -> {dst}: {err}")
+    if stats is not None:
+        stats.report()
+        report["bytes_saved"] = stats.bytes_saved
+    return report
@@ -0,0 +1,101 @@
+# ------------------------------------------------------------------------------
+# File: folder_runner.py
+# Description: Run an independent per-folder job (e.g. view selection of one
+#              "image" folder) over many folders, optionally in a process pool.
+#              Every folder gets a seed derived from its path relative to the
+#              dataset root, so randomized results do not depend on worker count
+#              or completion order. Failures and timings are collected per folder
+#              and summarized at the end instead of interrupting the run.
+#
+# Usage:
+#   results = run_folders(partial(select_one_folder, k=5), folders, max_workers=8,
+#                         initializer=init_worker, initargs=(metadata_root,))
+#   print_folder_summary(results)
+# ------------------------------------------------------------------------------
+
+import os
+import time
+import hashlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def folder_seed(folder, dataset_root, base_seed=0):
+    """Deterministic 32-bit seed from base_seed and the folder path relative to dataset_root"""
+    rel = os.path.relpath(os.path.abspath(folder), os.path.abspath(dataset_root)).replace(os.sep, "/")
+    digest = hashlib.sha256(f"{base_seed}:{rel}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "little")
+
+
+def _run_one(func, folder):
+    """Call func(folder) and wrap its outcome as a result dict; never raises"""
+    t0 = time.perf_counter()
+    try:
+        result = func(folder) or {}
+        result.setdefault("status", "ok")
+    except Exception as e:
+        result = {"status": "failed", "error": f"{type(e).__name__}: {e}",
+                  "traceback": traceback.format_exc()}
+    result["folder"] = folder
+    result["seconds"] = time.perf_counter() - t0
+    result.setdefault("log", [])
+    return result
+
+
+def _print_log(result):
+    for line in result["log"]:
+        print(line)
+    if result["status"] == "failed":
+        print(f"❌ Failed: {result['folder']} ({result['error']})")
+
+
+def run_folders(func, folders, max_workers=None, initializer=None, initargs=(), verbose=True):
+    """
+    Apply func(folder) -> dict to every folder and return the results in folder order.
+
+    max_workers None/1 runs in-process; otherwise folders are spread over a process pool
+    (func and initializer must then be picklable, i.e. module-level functions or partials).
+    Each result carries 'folder', 'status' ("ok" / "skipped" / "failed"), 'seconds',
+    'log' (messages of the job) and 'error' on failure.
+    """
+    folders = list(folders)
+    results = [None] * len(folders)
+    if not max_workers or max_workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for i, folder in enumerate(folders):
+            results[i] = _run_one(func, folder)
+            if verbose:
+                _print_log(results[i])
+        return results
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=initializer, initargs=initargs) as executor:
+        futures = {executor.submit(_run_one, func, folder): i for i, folder in enumerate(folders)}
+        for fut in as_completed(futures):
+            i = futures[fut]
+            try:
+                results[i] = fut.result()
+            except Exception as e:  # worker crashed (e.g. BrokenProcessPool)
+                results[i] = {"folder": folders[i], "status": "failed", "seconds": 0.0, "log": [],
+                              "error": f"{type(e).__name__}: {e}"}
+            if verbose:
+                _print_log(results[i])
+    return results
+
+
+def print_folder_summary(results, top=5):
+    """Print counts, total/slowest timings and all failures of a run_folders() call"""
+    if not results:
+        print("⚠️ No folders processed")
+        return
+    counts = {}
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    total = sum(r["seconds"] for r in results)
+    print(f"\n📋 {len(results)} folders: " + ", ".join(f"{k} {v}" for k, v in sorted(counts.items())) +
+          f" | folder time total {total:.1f}s")
+    for r in sorted(results, key=lambda r: r["seconds"], reverse=True)[:top]:
+        print(f"  ⏱️ {r['seconds']:.2f}s  {r['folder']}")
+    for r in results:
+        if r["status"] == "failed":
+            print(f"  ❌ {r['folder']}: {r['error']}")
@@ -0,0 +1,145 @@
+# ------------------------------------------------------------------------------
+# File: footprint_overlap.py
+# Description: Fast footprint-overlap pre-filter for candidate views.
+#              The four corners of a DSM tile at its minimum and maximum valid
+#              height (8 points) are projected through a view's RPC in a single
+#              vectorized call. The bounding box of the projected points is the
+#              tile footprint in image space (including height parallax); the
+#              overlap fraction is the part of that footprint lying inside the
+#              image. Views below a threshold can be dropped before any group
+#              enumeration in the selection scripts.
+#
+# Usage:
+#   overlaps = compute_view_overlaps(image_paths, dsm_path)   # {basename: fraction}
+#   kept = [p for p in image_paths if overlaps[os.path.basename(p)] >= 0.8]
+# ------------------------------------------------------------------------------
+
+import os
+import numpy as np
+import rasterio
+from RPCCore import RPCModelParameter
+from geo_utils import find_rpc_file, lonlat_transformers
+
+
+def valid_height_range(dsm, nodata):
+    """(h_min, h_max) of the finite, non-nodata cells of a DSM array at its native dtype, or None"""
+    if np.issubdtype(dsm.dtype, np.floating):
+        valid = np.isfinite(dsm)
+        if nodata is not None:
+            valid &= ~(np.abs(dsm - dsm.dtype.type(nodata)) < 1e-4)
+    else:
+        valid = np.ones(dsm.shape, dtype=bool) if nodata is None else dsm != nodata
+    if not valid.any():
+        return None
+    return float(dsm[valid].min()), float(dsm[valid].max())
+
+
+def read_tile_extent(dsm_path):
+    """
+    Lon/lat corners (4,) and valid height range of a DSM tile.
+    Projected DSMs (e.g. UTM tiles) are converted to WGS84 lon/lat.
+    The height range comes from the band statistics stored in the file if present,
+    otherwise from one read at the native dtype (no float64 copy of the tile).
+    """
+    with rasterio.open(dsm_path) as src:
+        rows, cols = src.height, src.width
+        transform = src.transform
+        crs = src.crs
+        tags = src.tags(1)
+        if "STATISTICS_MINIMUM" in tags and "STATISTICS_MAXIMUM" in tags:
+            h_range = (float(tags["STATISTICS_MINIMUM"]), float(tags["STATISTICS_MAXIMUM"]))
+        else:
+            h_range = valid_height_range(src.read(1), src.nodata)
+    xs, ys = transform * (np.array([0, cols, cols, 0], dtype=np.float64),
+                          np.array([0, 0, rows, rows], dtype=np.float64))
+    xs, ys = np.asarray(xs), np.asarray(ys)
+    transformers = lonlat_transformers(crs.to_wkt() if crs else None)
+    if transformers is not None:
+        xs, ys = transformers[0].transform(xs, ys)
+    return np.asarray(xs), np.asarray(ys), h_range
+
+
+def footprint_overlap_fraction(rpc, lons, lats, h_range, img_width, img_height):
+    """
+    Fraction of the tile footprint (bounding box of the 8 projected corner points)
+    that falls inside the [0, img_width] x [0, img_height] image.
+    """
+    h = np.repeat(np.asarray(h_range, dtype=np.float64), len(lons))
+    lat = np.tile(np.asarray(lats, dtype=np.float64), 2)
+    lon = np.tile(np.asarray(lons, dtype=np.float64), 2)
+    samp, line = rpc.RPC_OBJ2PHOTO(lat, lon, h)
+    samp, line = np.asarray(samp, dtype=np.float64), np.asarray(line, dtype=np.float64)
+    if not (np.all(np.isfinite(samp)) and np.all(np.isfinite(line))):
+        return 0.0
+
+    s0, s1 = samp.min(), samp.max()
+    l0, l1 = line.min(), line.max()
+    area = max(s1 - s0, 1e-6) * max(l1 - l0, 1e-6)
+    inter_w = max(0.0, min(s1, img_width) - max(s0, 0.0))
+    inter_h = max(0.0, min(l1, img_height) - max(l0, 0.0))
+    return float(min(1.0, inter_w * inter_h / area))
+
+
+def log_message(msg, log=None):
+    """Append msg to a folder job's log list (see folder_runner), or print it when there is none"""
+    if log is None:
+        print(msg)
+    else:
+        log.append(msg)
+
+
+def compute_view_overlaps(image_paths, dsm_path, log=None):
+    """{image basename: overlap fraction} of every view with one DSM tile; warnings go to log"""
+    lons, lats, h_range = read_tile_extent(dsm_path)
+    overlaps = {}
+    for image_path in image_paths:
+        name = os.path.basename(image_path)
+        if h_range is None:
+            overlaps[name] = 0.0
+            continue
+        try:
+            with rasterio.open(image_path) as src:
+                img_width, img_height = src.width, src.height
+            rpc = RPCModelParameter()
+            rpc.load_dirpc_from_file(find_rpc_file(image_path))
+            overlaps[name] = footprint_overlap_fraction(rpc, lons, lats, h_range, img_width, img_height)
+        except Exception as e:
+            log_message(f"⚠️ Overlap failed for {image_path}: {e}", log)
+            overlaps[name] = 0.0
+    return overlaps
+
+
+def us3d_dsm_path(image_path):
+    """Block DSM of a US3D image `<block>/image/JAX_004_007_RGB.tif` -> `<block>/DSM/JAX_004_DSM_wgs84.tif`"""
+    block_dir = os.path.dirname(os.path.dirname(os.path.abspath(image_path)))
+    return os.path.join(block_dir, "DSM", f"{os.path.basename(image_path)[:7]}_DSM_wgs84.tif")
+
+
+def filter_views_by_overlap(image_infos, dsm_path, min_overlap=0.8, log=None):
+    """
+    Drop views whose footprint overlap with their DSM tile is below min_overlap.
+
+    dsm_path is a single tile path or a callable image_path -> tile path. Views whose
+    tile does not exist are kept (overlap None) since they cannot be checked.
+    Warnings are appended to log (the folder job's message list) if given, else printed.
+    Returns (kept image_infos, {basename: overlap} for all views).
+    """
+    by_tile = {}
+    for info in image_infos:
+        tile = dsm_path(info['image_path']) if callable(dsm_path) else dsm_path
+        by_tile.setdefault(tile, []).append(info['image_path'])
+
+    overlaps = {}
+    for tile, paths in by_tile.items():
+        if not os.path.exists(tile):
+            log_message(f"⚠️ DSM tile not found, overlap not checked: {tile}", log)
+            overlaps.update({os.path.basename(p): None for p in paths})
+            continue
+        overlaps.update(compute_view_overlaps(paths, tile, log))
+
+    kept = []
+    for info in image_infos:
+        ov = overlaps[os.path.basename(info['image_path'])]
+        if ov is None or ov >= min_overlap:
+            kept.append(info)
+    return kept, overlaps
@@ -0,0 +1,70 @@
+# ------------------------------------------------------------------------------
+# File: geo_utils.py
+# Description: Small helpers shared by the height-map and view-selection scripts.
+#              - find_rpc_file: locate the RPC of an image in either dataset layout
+#                (US3D `<name>.rpc` next to the image, MVS3D `rpc/<name>_rpc.txt`).
+#              - lonlat_transformers: cached pyproj transformers between a projected
+#                DSM CRS (e.g. MVS3D UTM tiles) and WGS84 lon/lat.
+#              - compute_pair_matrices: pairwise view geometry (convergence angles
+#                and acquisition time differences) for the view-selection scripts
+#                (US3D and MVS3D).
+#
+# Usage:
+#   rpc_file = find_rpc_file(image_path)
+#   transformers = lonlat_transformers(src.crs.to_wkt())   # None for geographic DSMs
+#   if transformers: lon, lat = transformers[0].transform(x, y)
+#   angle_mat, time_diff_mat, times_seconds = compute_pair_matrices(image_infos)
+# ------------------------------------------------------------------------------
+
+import os
+from functools import lru_cache
+import numpy as np
+
+# 批量评分时每批组合数
+GROUP_BATCH_SIZE = 100000
+
+
+def find_rpc_file(image_path):
+    """RPC file of an image: US3D keeps `<name>.rpc` next to the image, MVS3D tiles keep `rpc/<name>_rpc.txt`."""
+    rpc_file = image_path.replace(".tif", ".rpc")
+    if os.path.exists(rpc_file):
+        return rpc_file
+    base_name = os.path.splitext(os.path.basename(image_path))[0]
+    block_dir = os.path.dirname(os.path.dirname(os.path.abspath(image_path)))
+    mvs3d_rpc_file = os.path.join(block_dir, "rpc", f"{base_name}_rpc.txt")
+    return mvs3d_rpc_file if os.path.exists(mvs3d_rpc_file) else rpc_file
+
+
+@lru_cache(maxsize=16)
+def lonlat_transformers(dsm_crs):
+    """(to_lonlat, from_lonlat) pyproj transformers for a projected DSM CRS, or None if geographic/unknown."""
+    if not dsm_crs:
+        return None
+    from pyproj import CRS, Transformer  # 只有投影 DSM 需要 pyproj，选片脚本不依赖它
+    crs = CRS.from_user_input(dsm_crs)
+    if crs.is_geographic:
+        return None
+    return (Transformer.from_crs(crs, "EPSG:4326", always_xy=True),
+            Transformer.from_crs("EPSG:4326", crs, always_xy=True))
+
+
+def compute_pair_matrices(image_infos):
+    """
+    一次向量化计算 n×n 交会角矩阵（度）与成像时间差矩阵（天），image_infos 为带 az/el/datetime 的字典列表；
+    交会角公式与各选片脚本的 compute_convergence_angle 相同。
+    返回 (angle_mat, time_diff_mat, times_seconds)，成像时间为相对最早影像的秒数。
+    """
+    az = np.radians([info['az'] for info in image_infos])
+    el = np.radians([info['el'] for info in image_infos])
+    cos_d = (np.sin(el)[:, None] * np.sin(el)[None, :] +
+             np.cos(el)[:, None] * np.cos(el)[None, :] * np.cos(az[:, None] - az[None, :]))
+    angle_mat = np.degrees(np.arccos(np.clip(cos_d, -1.0, 1.0)))
+
+    if image_infos:
+        t0 = min(info['datetime'] for info in image_infos)
+        seconds = np.array([(info['datetime'] - t0).total_seconds() for info in image_infos])
+    else:
+        seconds = np.zeros(0)
+    time_diff_mat = np.abs(seconds[:, None] - seconds[None, :]) / 86400
+    return angle_mat, time_diff_mat, seconds
+
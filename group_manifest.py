@@ -0,0 +1,227 @@
+# ------------------------------------------------------------------------------
+# File: group_manifest.py
+# Description: Manifest-only virtual dataset for the selected view groups.
+#              Instead of materializing out_root/<region>_<block>_<idx>/{image,rpc,
+#              height,DSM} folders, the organize stage writes one JSON Lines file:
+#              a header line followed by one record per group with the member paths
+#              (relative to dataset_root) taken from selected_best.json or
+#              selected_all_combinations.json. GroupManifestDataset resolves the
+#              samples lazily from the original block folders, so a new split or a
+#              resampled set of groups is only a metadata operation.
+#
+#              Path rules are the same as datarange_best.py / datarange_sample.py:
+#                image  : <block>/image/<name>.tif
+#                rpc    : <block>/image/<name>.rpc
+#                height : <block>/heightmap2/<name>_heightmap.tif
+#                dsm    : <block>/dsm/<region>_<block_id>_DSM_geo.tif
+#
+# Usage:
+#   write_group_manifest(dataset_root, "train.jsonl", source="sample")
+#   ds = GroupManifestDataset("train.jsonl")
+#   sample = ds[0]        # {"group", "images", "rpcs", "heights", "dsm", "record"}
+# ------------------------------------------------------------------------------
+
+import os
+import json
+import random
+import numpy as np
+
+MANIFEST_VERSION = 1
+SELECTION_FILES = {"best": "selected_best.json", "sample": "selected_all_combinations.json"}
+SAMPLE_FIELDS = ("image", "rpc", "height", "dsm")
+
+
+def read_selected_groups(json_path, source):
+    """List of (image names, extra info) from a selection JSON"""
+    with open(json_path, "r") as f:
+        data = json.load(f)
+    if source == "best":
+        return [(g.get("images", []), {k: g[k] for k in ("score", "time_span", "avg_angle") if k in g})
+                for g in data.get("top_groups", [])]
+    return [(combo, {}) for combo in data.get("all_combinations", [])]
+
+
+def parse_region_block(image_name):
+    """(region, block_id) from an image name <region>_<block>_<...>.tif, or None if malformed"""
+    try:
+        region, block_id, _ = image_name.split('_')[0:3]
+    except ValueError:
+        return None
+    return region, block_id
+
+
+def group_record(dataset_root, image_folder, images, group_name):
+    """Manifest record of one group; paths are relative to dataset_root with '/' separators"""
+    block_dir = os.path.dirname(image_folder)
+    parsed = parse_region_block(images[0])
+    if parsed is None:
+        raise ValueError(f"Invalid filename format: {images[0]}")
+    region, block_id = parsed
+
+    def rel(path):
+        return os.path.relpath(path, dataset_root).replace(os.sep, "/")
+
+    record = {
+        "group": group_name,
+        "images": [rel(os.path.join(image_folder, name)) for name in images],
+        "rpcs": [rel(os.path.join(image_folder, name.replace(".tif", ".rpc"))) for name in images],
+        "heights": [rel(os.path.join(block_dir, "heightmap2", name.replace(".tif", "_heightmap.tif")))
+                    for name in images],
+        "dsm": rel(os.path.join(block_dir, "dsm", f"{region}_{block_id}_DSM_geo.tif")),
+    }
+    missing = [p for p in record["images"] + record["rpcs"] + record["heights"] + [record["dsm"]]
+               if not os.path.exists(os.path.join(dataset_root, p))]
+    if missing:
+        record["missing"] = missing
+    return record
+
+
+def write_group_manifest(dataset_root, manifest_path, source="best"):
+    """
+    Walk all image folders under dataset_root and write one JSON Lines manifest of the
+    selected groups. source="best" reads selected_best.json (group names <region>_<block>_<i>),
+    source="sample" reads selected_all_combinations.json (<region>_<block>_<iii>).
+    Returns the number of group records written.
+    """
+    json_name = SELECTION_FILES[source]
+    n_groups = n_missing = 0
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    with open(manifest_path, "w") as f:
+        header = {"manifest_version": MANIFEST_VERSION, "dataset_root": os.path.abspath(dataset_root),
+                  "source": source}
+        f.write(json.dumps(header) + "\n")
+        for root, dirs, files in sorted(os.walk(dataset_root)):
+            if os.path.basename(root).lower() != "image" or json_name not in files:
+                continue
+            for idx, (images, extra) in enumerate(read_selected_groups(os.path.join(root, json_name), source), 1):
+                if not images:
+                    continue
+                parsed = parse_region_block(images[0])
+                if parsed is None:
+                    print(f"⚠️ Invalid filename format: {images[0]} (group {idx} in {os.path.join(root, json_name)})")
+                    continue
+                region, block_id = parsed
+                group_name = f"{region}_{block_id}_{idx}" if source == "best" else f"{region}_{block_id}_{idx:03d}"
+                record = group_record(dataset_root, root, images, group_name)
+                record.update(extra)
+                n_missing += "missing" in record
+                f.write(json.dumps(record) + "\n")
+                n_groups += 1
+    print(f"📝 Manifest written: {manifest_path} ({n_groups} groups, {n_missing} with missing files)")
+    return n_groups
+
+
+def read_manifest(manifest_path):
+    """(header, records) of a manifest file"""
+    with open(manifest_path, "r") as f:
+        header = json.loads(f.readline())
+        records = [json.loads(line) for line in f if line.strip()]
+    return header, records
+
+
+def write_manifest_records(manifest_path, header, records):
+    with open(manifest_path, "w") as f:
+        f.write(json.dumps(header) + "\n")
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def split_manifest(manifest_path, out_paths, ratios, seed=0):
+    """
+    Split a manifest into several manifests by block (all groups of one block end up in
+    the same split, so train/test never share a DSM block). Pure metadata operation.
+
+    Args:
+        out_paths (list[str]): one output manifest per split.
+        ratios (list[float]): relative size of each split (by number of blocks).
+    """
+    header, records = read_manifest(manifest_path)
+    blocks = sorted({record_block(r) for r in records})
+    random.Random(seed).shuffle(blocks)
+
+    total = float(sum(ratios))
+    bounds = np.round(np.cumsum(ratios) / total * len(blocks)).astype(int)
+    assignment = {}
+    start = 0
+    for split_idx, end in enumerate(bounds):
+        for b in blocks[start:end]:
+            assignment[b] = split_idx
+        start = end
+
+    for split_idx, out_path in enumerate(out_paths):
+        subset = [r for r in records if assignment[record_block(r)] == split_idx]
+        write_manifest_records(out_path, header, subset)
+        print(f"📝 Split {split_idx}: {len(subset)} groups -> {out_path}")
+
+
+def record_block(record):
+    """Block folder (relative path) of a manifest record"""
+    return record["images"][0].rsplit("/", 2)[0]
+
+
+class GroupManifestDataset:
+    """
+    Lazy view-group dataset backed by a manifest: nothing is read until a sample is
+    accessed, and then only the requested fields.
+    """
+
+    def __init__(self, manifest_path, dataset_root=None, fields=SAMPLE_FIELDS, skip_missing=True):
+        header, records = read_manifest(manifest_path)
+        self.header = header
+        self.dataset_root = dataset_root or header["dataset_root"]
+        self.fields = tuple(fields)
+        self.records = [r for r in records if not (skip_missing and r.get("missing"))]
+
+    def __len__(self):
+        return len(self.records)
+
+    def resolve(self, rel_path):
+        return os.path.join(self.dataset_root, *rel_path.split("/"))
+
+    def paths(self, index):
+        """Absolute member paths of one group, without reading any file"""
+        r = self.records[index]
+        return {
+            "images": [self.resolve(p) for p in r["images"]],
+            "rpcs": [self.resolve(p) for p in r["rpcs"]],
+            "heights": [self.resolve(p) for p in r["heights"]],
+            "dsm": self.resolve(r["dsm"]),
+        }
+
+    # rasterio / RPCCore are only needed to read samples, not to write or split manifests
+    @staticmethod
+    def _read_raster(path):
+        import rasterio
+        with rasterio.open(path) as src:
+            return src.read()
+
+    @staticmethod
+    def _read_rpc(path):
+        from RPCCore import RPCModelParameter
+        rpc = RPCModelParameter()
+        rpc.load_dirpc_from_file(path)
+        return rpc
+
+    def __getitem__(self, index):
+        paths = self.paths(index)
+        sample = {"group": self.records[index]["group"], "record": self.records[index]}
+        if "image" in self.fields:
+            sample["images"] = [self._read_raster(p) for p in paths["images"]]
+        if "rpc" in self.fields:
+            sample["rpcs"] = [self._read_rpc(p) for p in paths["rpcs"]]
+        if "height" in self.fields:
+            sample["heights"] = [self._read_raster(p)[0] for p in paths["heights"]]
+        if "dsm" in self.fields:
+            sample["dsm"] = self._read_raster(paths["dsm"])[0]
+        return sample
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def subset(self, indices):
+        """A new dataset over the selected records (shares the header and root)"""
+        ds = object.__new__(GroupManifestDataset)
+        ds.header, ds.dataset_root, ds.fields = self.header, self.dataset_root, self.fields
+        ds.records = [self.records[i] for i in indices]
+        return ds
@@ -0,0 +1,214 @@
+# ------------------------------------------------------------------------------
+# File: imd_store.py
+# Description: Persistent metadata store for DigitalGlobe/Maxar .IMD files.
+#              Every IMD is parsed once in a single pass (acquisition time, mean
+#              satellite azimuth/elevation, sun angles, GSD, off-nadir angle) and the
+#              values are kept in a small SQLite table next to the metadata, keyed by
+#              (region, image_id). Later runs only re-parse IMDs whose mtime/size
+#              changed, so the selection scripts load all metadata with one query
+#              instead of opening thousands of small files per block.
+#
+#              region   = sub-directory of metadata_root ("" for a flat folder)
+#              image_id = IMD file name without extension
+#
+#              The store defaults to <metadata_root>/imd_store.sqlite; pass db_path
+#              to keep it elsewhere when the metadata tree is read-only.
+#
+# Usage:
+#   records = load_imd_records(metadata_root)          # refresh + load
+#   refresh_imd_store(metadata_root, db_path)          # refresh only (e.g. before a process pool)
+#   rec = records.get(("JAX", "01"))                   # US3D: <root>/JAX/01.IMD
+#   rec["datetime"], rec["sat_az"], rec["sat_el"]
+# ------------------------------------------------------------------------------
+
+import os
+import re
+import sqlite3
+from datetime import datetime
+
+DEFAULT_STORE_NAME = "imd_store.sqlite"
+
+# IMD 字段名 -> 数据库列名（数值字段）
+IMD_NUMERIC_FIELDS = {
+    "meanSatAz": "sat_az",
+    "meanSatEl": "sat_el",
+    "meanSunAz": "sun_az",
+    "meanSunEl": "sun_el",
+    "meanProductGSD": "gsd",
+    "meanOffNadirViewAngle": "off_nadir",
+}
+NUMERIC_COLUMNS = tuple(IMD_NUMERIC_FIELDS.values())
+
+_NUMBER_RE = re.compile(r"[-+]?[0-9]*\.?[0-9]+")
+_TIME_RE = re.compile(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})")
+_FIELD_RE = re.compile(r"^\s*(\w+)\s*=")
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS imd (
+    region TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    mtime REAL,
+    size INTEGER,
+    first_line_time TEXT,
+    {", ".join(f"{c} REAL" for c in NUMERIC_COLUMNS)},
+    PRIMARY KEY (region, image_id)
+)
+"""
+
+
+def parse_imd_text(text):
+    """
+    Parse the fields used by the selection scripts from IMD text in one pass.
+    Same rules as extract_imd_datetime / extract_imd_angles: the first firstLineTime
+    wins (second precision), numeric fields take the last occurrence.
+    """
+    record = {"first_line_time": None}
+    record.update({c: None for c in NUMERIC_COLUMNS})
+    for line in text.splitlines():
+        if "firstLineTime" in line:
+            if record["first_line_time"] is None:
+                match = _TIME_RE.search(line)
+                if match:
+                    record["first_line_time"] = match.group(1)
+            continue
+        field = _FIELD_RE.match(line)
+        if field and field.group(1) in IMD_NUMERIC_FIELDS:
+            match = _NUMBER_RE.search(line[field.end():])
+            if match:
+                record[IMD_NUMERIC_FIELDS[field.group(1)]] = float(match.group())
+    return record
+
+
+def parse_imd_file(imd_path):
+    with open(imd_path, "r", encoding="utf-8", errors="ignore") as f:
+        return parse_imd_text(f.read())
+
+
+def iter_imd_files(metadata_root):
+    """Yield (region, image_id, path, stat) for every *.IMD under metadata_root (case-insensitive)"""
+    stack = [metadata_root]
+    while stack:
+        folder = stack.pop()
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                stack.append(entry.path)
+            elif entry.name.lower().endswith(".imd"):
+                rel_dir = os.path.relpath(folder, metadata_root)
+                region = "" if rel_dir == "." else rel_dir.replace(os.sep, "/")
+                yield region, os.path.splitext(entry.name)[0], entry.path, entry.stat()
+
+
+class IMDStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def upsert(self, region, image_id, path, record, mtime=None, size=None, commit=True):
+        """Insert or replace one parsed IMD record (e.g. harvested from a tar member)"""
+        cols = ("region", "image_id", "path", "mtime", "size", "first_line_time") + NUMERIC_COLUMNS
+        values = (region, image_id, path, mtime, size, record.get("first_line_time")) + \
+                 tuple(record.get(c) for c in NUMERIC_COLUMNS)
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO imd ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})", values)
+        if commit:
+            self.conn.commit()
+
+    def refresh(self, metadata_root, prune=True):
+        """
+        Incrementally sync the store with the IMD files under metadata_root:
+        only new files or files whose mtime/size changed are parsed.
+        Returns a dict with counts of parsed / unchanged / removed entries.
+        """
+        known = {(r, i): (p, m, s) for r, i, p, m, s in
+                 self.conn.execute("SELECT region, image_id, path, mtime, size FROM imd")}
+        seen = set()
+        parsed = unchanged = 0
+        for region, image_id, path, st in iter_imd_files(metadata_root):
+            key = (region, image_id)
+            seen.add(key)
+            old = known.get(key)
+            if old is not None and old[0] == path and old[1] == st.st_mtime and old[2] == st.st_size:
+                unchanged += 1
+                continue
+            try:
+                record = parse_imd_file(path)
+            except OSError as e:
+                print(f"❌ Error reading {path}: {e}")
+                continue
+            self.upsert(region, image_id, path, record, st.st_mtime, st.st_size, commit=False)
+            parsed += 1
+
+        removed = 0
+        if prune:
+            # 只删除磁盘上已不存在的文件记录（来自 tar 的记录 mtime 为空，保留）
+            stale = [k for k, (p, m, _) in known.items() if k not in seen and m is not None and not os.path.exists(p)]
+            self.conn.executemany("DELETE FROM imd WHERE region = ? AND image_id = ?", stale)
+            removed = len(stale)
+        self.conn.commit()
+        return {"parsed": parsed, "unchanged": unchanged, "removed": removed}
+
+    _COLUMNS = ("region", "image_id", "path", "first_line_time") + NUMERIC_COLUMNS
+
+    @classmethod
+    def _to_record(cls, row):
+        rec = dict(zip(cls._COLUMNS, row))
+        t = rec["first_line_time"]
+        rec["datetime"] = datetime.strptime(t, "%Y-%m-%dT%H:%M:%S") if t else None
+        return rec
+
+    def load_all(self):
+        """All records as {(region, image_id): dict}, with 'datetime' already converted"""
+        rows = self.conn.execute(f"SELECT {', '.join(self._COLUMNS)} FROM imd")
+        return {(row[0], row[1]): self._to_record(row) for row in rows}
+
+    def get(self, region, image_id):
+        row = self.conn.execute(f"SELECT {', '.join(self._COLUMNS)} FROM imd WHERE region = ? AND image_id = ?",
+                                (region, image_id)).fetchone()
+        return self._to_record(row) if row else None
+
+
+def default_db_path(metadata_root):
+    return os.path.join(metadata_root, DEFAULT_STORE_NAME)
+
+
+def refresh_imd_store(metadata_root, db_path=None):
+    """
+    Incrementally sync the store with the IMD files under metadata_root without loading
+    the records. db_path defaults to <metadata_root>/imd_store.sqlite.
+    Returns the counts of IMDStore.refresh.
+    """
+    db_path = db_path or default_db_path(metadata_root)
+    with IMDStore(db_path) as store:
+        stats = store.refresh(metadata_root)
+    if stats["parsed"] or stats["removed"]:
+        print(f"🗂️ IMD store {db_path}: parsed {stats['parsed']}, "
+              f"unchanged {stats['unchanged']}, removed {stats['removed']}")
+    return stats
+
+
+def load_imd_records(metadata_root, db_path=None, refresh=True):
+    """
+    Refresh (incrementally, unless refresh=False) and load the metadata store for
+    metadata_root. db_path defaults to <metadata_root>/imd_store.sqlite.
+    """
+    db_path = db_path or default_db_path(metadata_root)
+    if refresh:
+        refresh_imd_store(metadata_root, db_path)
+    with IMDStore(db_path) as store:
+        return store.load_all()
@@ -0,0 +1,142 @@
+# ------------------------------------------------------------------------------
+# File: rpc_approx.py
+# Description: Approximate RPC ground-to-image projection.
+#              The exact rational-polynomial RPC is evaluated on a coarse 3-D
+#              (lon, lat, height) control grid covering the area of interest, and
+#              image coordinates of all other points are obtained by trilinear
+#              interpolation (same idea as GDAL's approximate transformer).
+#              The grid is checked against the exact RPC at the cell centres; if the
+#              error stays above `max_error` pixels after refinement, the projector
+#              falls back to exact evaluation.
+#
+# Usage:
+#   rpc = RPCModelParameter(); rpc.load_dirpc_from_file(rpc_file)
+#   proj = ApproxRPCProjector(rpc, (lon_min, lon_max), (lat_min, lat_max), (h_min, h_max))
+#   samp, line = proj.RPC_OBJ2PHOTO(lat, lon, h)    # drop-in for rpc.RPC_OBJ2PHOTO
+# ------------------------------------------------------------------------------
+
+import numpy as np
+
+
+class ApproxRPCProjector:
+    def __init__(self, rpc, lon_range, lat_range, h_range, grid_shape=(16, 16, 5),
+                 max_error=0.1, max_refinements=2):
+        """
+        Args:
+            rpc: exact RPC model exposing RPC_OBJ2PHOTO(lat, lon, h) -> (samp, line).
+            lon_range, lat_range, h_range (tuple): (min, max) extent of the control grid.
+            grid_shape (tuple): initial number of nodes along (lon, lat, height).
+            max_error (float): maximum allowed interpolation error in pixels.
+            max_refinements (int): how many times the grid may be doubled before
+                falling back to exact evaluation.
+        """
+        self.rpc = rpc
+        self.max_error = max_error
+        self.exact_fallback = False
+
+        lo = np.array([lon_range[0], lat_range[0], h_range[0]], dtype=np.float64)
+        hi = np.array([lon_range[1], lat_range[1], h_range[1]], dtype=np.float64)
+        # 高程范围退化（如平坦区域）时留出一点余量，避免网格步长为 0
+        hi = np.where(hi - lo > 1e-9, hi, lo + np.array([1e-6, 1e-6, 1.0]))
+        self.lo, self.hi = lo, hi
+
+        shape = np.maximum(np.asarray(grid_shape, dtype=np.int64), 2)
+        for _ in range(max_refinements + 1):
+            self._build_grid(shape)
+            self.grid_error = self._check_error()
+            if self.grid_error <= max_error:
+                break
+            shape = (shape - 1) * 2 + 1
+        else:
+            self.exact_fallback = True
+
+    def __getattr__(self, name):
+        # 其余属性（RPC_PHOTO2OBJ、偏移量等）直接转交给精确 RPC
+        if name == "rpc":
+            raise AttributeError(name)
+        return getattr(self.rpc, name)
+
+    def _build_grid(self, shape):
+        self.shape = shape
+        self.step = (self.hi - self.lo) / (shape - 1)
+        axes = [np.linspace(self.lo[d], self.hi[d], shape[d]) for d in range(3)]
+        lon, lat, h = np.meshgrid(*axes, indexing="ij")
+        samp, line = self.rpc.RPC_OBJ2PHOTO(lat.ravel(), lon.ravel(), h.ravel())
+        self.grid_samp = np.asarray(samp, dtype=np.float64).reshape(lon.shape)
+        self.grid_line = np.asarray(line, dtype=np.float64).reshape(lon.shape)
+
+    def _check_error(self):
+        """Max pixel error of the interpolated grid, measured at the centre of every cell."""
+        axes = [self.lo[d] + (np.arange(self.shape[d] - 1) + 0.5) * self.step[d] for d in range(3)]
+        lon, lat, h = (a.ravel() for a in np.meshgrid(*axes, indexing="ij"))
+        samp, line = self.rpc.RPC_OBJ2PHOTO(lat, lon, h)
+        samp_i, line_i = self._interpolate(lon, lat, h)
+        err = np.hypot(np.asarray(samp, dtype=np.float64) - samp_i,
+                       np.asarray(line, dtype=np.float64) - line_i)
+        return float(np.nanmax(err)) if err.size else 0.0
+
+    def _interpolate(self, lon, lat, h):
+        pts = np.stack([lon, lat, h])
+        f = (pts - self.lo[:, None]) / self.step[:, None]
+        i0 = np.clip(np.floor(f), 0, (self.shape - 2)[:, None]).astype(np.int64)
+        t = f - i0
+
+        samp = np.zeros(lon.shape, dtype=np.float64)
+        line = np.zeros(lon.shape, dtype=np.float64)
+        for dx in (0, 1):
+            wx = t[0] if dx else 1.0 - t[0]
+            for dy in (0, 1):
+                wy = t[1] if dy else 1.0 - t[1]
+                for dz in (0, 1):
+                    wz = t[2] if dz else 1.0 - t[2]
+                    w = wx * wy * wz
+                    idx = (i0[0] + dx, i0[1] + dy, i0[2] + dz)
+                    samp += w * self.grid_samp[idx]
+                    line += w * self.grid_line[idx]
+        return samp, line
+
+    def RPC_OBJ2PHOTO(self, inlat, inlon, inhei):
+        lat = np.asarray(inlat, dtype=np.float64)
+        lon = np.asarray(inlon, dtype=np.float64)
+        hei = np.asarray(inhei, dtype=np.float64)
+        if self.exact_fallback:
+            return self.rpc.RPC_OBJ2PHOTO(lat, lon, hei)
+
+        shape = np.broadcast(lat, lon, hei).shape
+        lat, lon, hei = (np.broadcast_to(a, shape).ravel() for a in (lat, lon, hei))
+        samp, line = self._interpolate(lon, lat, hei)
+
+        # 控制网格范围之外的点不做外推，改用精确 RPC
+        pts = np.stack([lon, lat, hei])
+        outside = np.any((pts < self.lo[:, None]) | (pts > self.hi[:, None]), axis=0)
+        if outside.any():
+            s_exact, l_exact = self.rpc.RPC_OBJ2PHOTO(lat[outside], lon[outside], hei[outside])
+            samp[outside] = s_exact
+            line[outside] = l_exact
+        return samp.reshape(shape), line.reshape(shape)
+
+
+def make_approx_projector(rpc, dsm, dsm_transform, dsm_nodata=None, max_error=0.1, to_lonlat=None, **kwargs):
+    """
+    Build an ApproxRPCProjector covering a DSM raster (its footprint and valid height range).
+
+    `to_lonlat(cols, rows)` maps DSM pixel coordinates to lon/lat; by default the DSM is
+    assumed to be geographic and `dsm_transform` is used directly.
+    """
+    rows, cols = dsm.shape
+    corner_cols = np.array([0, cols, 0, cols], dtype=np.float64)
+    corner_rows = np.array([0, 0, rows, rows], dtype=np.float64)
+    if to_lonlat is None:
+        xs, ys = dsm_transform * (corner_cols, corner_rows)
+    else:
+        xs, ys = to_lonlat(corner_cols, corner_rows)
+    xs, ys = np.asarray(xs), np.asarray(ys)
+    valid = np.isfinite(dsm)
+    if dsm_nodata is not None:
+        valid &= ~(np.abs(dsm - dsm_nodata) < 1e-4)
+    if not valid.any():
+        return rpc
+    heights = dsm[valid]
+    return ApproxRPCProjector(rpc, (xs.min(), xs.max()), (ys.min(), ys.max()),
+                              (float(heights.min()), float(heights.max())),
+                              max_error=max_error, **kwargs)
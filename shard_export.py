@@ -0,0 +1,319 @@
+# ------------------------------------------------------------------------------
+# File: shard_export.py
+# Description: Pack view groups into fixed-size tar shards for training.
+#              The group folders written by datarange_best.py / datarange_sample.py
+#              (<group>/{image,rpc,height,DSM}) or a group manifest (group_manifest.py)
+#              are decoded once and stored as .npy members of plain tar files:
+#                <key>.json          group name, view names, DSM georeference
+#                <key>.image.<i>.npy decoded image (bands, H, W)
+#                <key>.rpc.npy       parsed RPC coefficients (n_views, 90), see RPC_KEYS
+#                <key>.height.<i>.npy heightmap of view i (H, W)
+#                <key>.dsm.npy       block DSM (H, W)
+#              A new shard is started once max_shard_bytes is reached. index.json
+#              stores the byte offset of every member, so ShardDataset reads one
+#              sample with a seek per member (no tar parsing, no TIFF decoding), and
+#              iter_shard_samples() streams whole shards sequentially.
+#              Samples have the GroupManifestDataset keys, except that "rpcs" is
+#              the (n_views, 90) coefficient array instead of RPC model objects.
+#
+# Usage:
+#   export_shards(iter_group_folders(out_root), shard_dir)
+#   ds = ShardDataset(shard_dir); sample = ds[0]
+#   for sample in iter_shard_samples(shard_dir): ...
+# ------------------------------------------------------------------------------
+
+import io
+import os
+import json
+import time
+import random
+import tarfile
+import numpy as np
+import rasterio
+
+from group_manifest import GroupManifestDataset
+
+SHARD_FORMAT_VERSION = 1
+INDEX_NAME = "index.json"
+
+# 90 个 RPC 参数的固定顺序：10 个偏移/比例 + 4 x 20 个多项式系数
+RPC_KEYS = (
+    ["LINE_OFF", "SAMP_OFF", "LAT_OFF", "LONG_OFF", "HEIGHT_OFF",
+     "LINE_SCALE", "SAMP_SCALE", "LAT_SCALE", "LONG_SCALE", "HEIGHT_SCALE"]
+    + [f"{name}_{i}" for name in ("LINE_NUM_COEFF", "LINE_DEN_COEFF", "SAMP_NUM_COEFF", "SAMP_DEN_COEFF")
+       for i in range(1, 21)]
+)
+
+
+def parse_rpc_file(rpc_path):
+    """RPC text file ("LINE_OFF: 1234.5 pixels" per line) -> float64 vector in RPC_KEYS order"""
+    values = {}
+    with open(rpc_path, "r") as f:
+        for line in f:
+            if ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            try:
+                values[key.strip().upper()] = float(value.split()[0])
+            except (ValueError, IndexError):
+                continue
+    missing = [k for k in RPC_KEYS if k not in values]
+    if missing:
+        raise ValueError(f"RPC file {rpc_path} lacks {len(missing)} coefficients (e.g. {missing[0]})")
+    return np.array([values[k] for k in RPC_KEYS], dtype=np.float64)
+
+
+def rpc_vector_to_dict(vector):
+    """Inverse of parse_rpc_file: {RPC key: value}"""
+    return dict(zip(RPC_KEYS, (float(v) for v in vector)))
+
+
+def iter_group_folders(groups_root):
+    """(group name, paths) for every <group>/{image,rpc,height,DSM} folder under groups_root"""
+    for group in sorted(os.listdir(groups_root)):
+        image_dir = os.path.join(groups_root, group, "image")
+        if not os.path.isdir(image_dir):
+            continue
+        names = sorted(f for f in os.listdir(image_dir) if f.endswith(".tif"))
+        dsm_dir = os.path.join(groups_root, group, "DSM")
+        dsm_files = sorted(f for f in os.listdir(dsm_dir) if f.endswith(".tif")) if os.path.isdir(dsm_dir) else []
+        yield group, {
+            "images": [os.path.join(image_dir, n) for n in names],
+            "rpcs": [os.path.join(groups_root, group, "rpc", n.replace(".tif", ".rpc")) for n in names],
+            "heights": [os.path.join(groups_root, group, "height", n.replace(".tif", "_heightmap.tif"))
+                        for n in names],
+            "dsm": os.path.join(dsm_dir, dsm_files[0]) if dsm_files else None,
+        }
+
+
+def iter_manifest_groups(manifest_path, dataset_root=None):
+    """(group name, paths) for every record of a group manifest (see group_manifest.py)"""
+    ds = GroupManifestDataset(manifest_path, dataset_root=dataset_root, fields=())
+    for i in range(len(ds)):
+        yield ds.records[i]["group"], ds.paths(i)
+
+
+def _read_band(path):
+    with rasterio.open(path) as src:
+        return src.read(1)
+
+
+def load_group_arrays(group, paths):
+    """Decode one group: list of (member suffix, array) plus the JSON metadata"""
+    arrays = []
+    for i, image_path in enumerate(paths["images"]):
+        with rasterio.open(image_path) as src:
+            arrays.append((f"image.{i}", src.read()))
+    arrays.append(("rpc", np.stack([parse_rpc_file(p) for p in paths["rpcs"]])))
+    for i, height_path in enumerate(paths["heights"]):
+        arrays.append((f"height.{i}", _read_band(height_path)))
+
+    with rasterio.open(paths["dsm"]) as src:
+        arrays.append(("dsm", src.read(1)))
+        meta = {
+            "group": group,
+            "views": [os.path.basename(p) for p in paths["images"]],
+            "dsm_name": os.path.basename(paths["dsm"]),
+            "dsm_transform": list(src.transform)[:6],
+            "dsm_crs": src.crs.to_wkt() if src.crs else None,
+            "dsm_nodata": src.nodata,
+        }
+    return arrays, meta
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+    return len(data)
+
+
+def _npy_bytes(array):
+    buf = io.BytesIO()
+    np.save(buf, np.ascontiguousarray(array), allow_pickle=False)
+    return buf.getvalue()
+
+
+def _member_offsets(shard_path):
+    """{member name: [data offset, size]} of a finished shard"""
+    with tarfile.open(shard_path, "r:") as tar:
+        return {m.name: [m.offset_data, m.size] for m in tar.getmembers()}
+
+
+def export_shards(groups, out_dir, max_shard_bytes=1 << 30, max_samples_per_shard=None):
+    """
+    Pack (group name, paths) items (iter_group_folders / iter_manifest_groups) into
+    out_dir/shard-XXXXXX.tar and write out_dir/index.json.
+
+    Args:
+        max_shard_bytes (int): a new shard is started once a shard reaches this size.
+        max_samples_per_shard (int): optional cap on the number of groups per shard.
+    Returns:
+        The index dict.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    shards, samples, failed = [], [], []
+    state = {"tar": None, "name": None, "bytes": 0, "count": 0, "samples": []}
+
+    def close_shard():
+        if state["tar"] is None:
+            return
+        state["tar"].close()
+        part = os.path.join(out_dir, state["name"] + ".part")
+        shard_path = os.path.join(out_dir, state["name"])
+        os.replace(part, shard_path)
+        offsets = _member_offsets(shard_path)
+        for sample in state["samples"]:
+            sample["members"] = {m: offsets[f"{sample['key']}.{m}"] for m in sample["members"]}
+        shards.append({"name": state["name"], "samples": state["count"], "bytes": os.path.getsize(shard_path)})
+        samples.extend(state["samples"])
+        print(f"📦 {state['name']}: {state['count']} groups, {state['bytes'] / 2**20:.1f} MiB")
+        state.update(tar=None, bytes=0, count=0, samples=[])
+
+    t0 = time.perf_counter()
+    for group, paths in groups:
+        try:
+            arrays, meta = load_group_arrays(group, paths)
+        except Exception as e:
+            print(f"❌ Skip group {group}: {e}")
+            failed.append(group)
+            continue
+
+        if state["tar"] is None:
+            state["name"] = f"shard-{len(shards):06d}.tar"
+            state["tar"] = tarfile.open(os.path.join(out_dir, state["name"] + ".part"), "w", format=tarfile.GNU_FORMAT)
+
+        key = f"{len(samples) + len(state['samples']):08d}"
+        members = ["json"]
+        state["bytes"] += _add_member(state["tar"], f"{key}.json", json.dumps(meta).encode("utf-8"))
+        for suffix, array in arrays:
+            members.append(f"{suffix}.npy")
+            state["bytes"] += _add_member(state["tar"], f"{key}.{suffix}.npy", _npy_bytes(array))
+        state["samples"].append({"key": key, "group": group, "shard": len(shards),
+                                 "n_views": len(paths["images"]), "members": members})
+        state["count"] += 1
+
+        if state["bytes"] >= max_shard_bytes or (max_samples_per_shard and state["count"] >= max_samples_per_shard):
+            close_shard()
+    close_shard()
+
+    index = {
+        "format_version": SHARD_FORMAT_VERSION,
+        "rpc_keys": RPC_KEYS,
+        "shards": shards,
+        "samples": samples,
+        "failed": failed,
+    }
+    index_path = os.path.join(out_dir, INDEX_NAME)
+    with open(index_path + ".part", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".part", index_path)
+    print(f"✅ Exported {len(samples)} groups into {len(shards)} shards in {time.perf_counter() - t0:.1f}s "
+          f"({len(failed)} failed) -> {out_dir}")
+    return index
+
+
+def assemble_sample(meta, arrays):
+    """
+    Sample dict from the decoded members of one group. The keys are those of
+    GroupManifestDataset, but "rpcs" is the raw (n_views, 90) float64 coefficient
+    array in RPC_KEYS order, not a list of RPCModelParameter objects.
+    """
+    n_views = len(meta["views"])
+    return {
+        "group": meta["group"],
+        "record": meta,
+        "images": [arrays[f"image.{i}.npy"] for i in range(n_views)],
+        "rpcs": arrays["rpc.npy"],
+        "heights": [arrays[f"height.{i}.npy"] for i in range(n_views)],
+        "dsm": arrays["dsm.npy"],
+    }
+
+
+class ShardDataset:
+    """
+    Random access to exported groups through index.json; shard files are opened lazily.
+
+    Samples have the keys of GroupManifestDataset ("group", "record", "images", "rpcs",
+    "heights", "dsm") and images / heights / dsm are the same decoded arrays. The type of
+    "rpcs" differs: it is a (n_views, 90) float64 array of raw coefficients in RPC_KEYS
+    order (use rpc_vector_to_dict for a {key: value} view), not RPCModelParameter objects,
+    so reading shards needs neither RPCCore nor the RPC text files.
+    """
+
+    def __init__(self, shard_dir):
+        with open(os.path.join(shard_dir, INDEX_NAME), "r") as f:
+            self.index = json.load(f)
+        if self.index.get("format_version") != SHARD_FORMAT_VERSION:
+            raise ValueError(f"Unsupported shard format: {self.index.get('format_version')}")
+        self.shard_dir = shard_dir
+        self.samples = self.index["samples"]
+        self._files = {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _file(self, shard):
+        # 每个进程各自打开（DataLoader worker 会复制对象，不共享文件句柄）
+        key = (os.getpid(), shard)
+        if key not in self._files:
+            self._files[key] = open(os.path.join(self.shard_dir, self.index["shards"][shard]["name"]), "rb")
+        return self._files[key]
+
+    def __getitem__(self, index):
+        sample = self.samples[index]
+        f = self._file(sample["shard"])
+        meta, arrays = None, {}
+        for member, (offset, size) in sample["members"].items():
+            f.seek(offset)
+            if member == "json":
+                meta = json.loads(f.read(size).decode("utf-8"))
+            else:
+                arrays[member] = np.lib.format.read_array(f, allow_pickle=False)
+        return assemble_sample(meta, arrays)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+def iter_shard_samples(shard_dir, shuffle_shards=False, seed=0):
+    """
+    Stream samples shard by shard with sequential reads only (one open per shard).
+    shuffle_shards randomizes the shard order, e.g. once per epoch.
+    Samples are the same dicts as ShardDataset's ("rpcs" is a coefficient array).
+    """
+    with open(os.path.join(shard_dir, INDEX_NAME), "r") as f:
+        shard_names = [s["name"] for s in json.load(f)["shards"]]
+    if shuffle_shards:
+        random.Random(seed).shuffle(shard_names)
+
+    for name in shard_names:
+        current_key, meta, arrays = None, None, {}
+        with tarfile.open(os.path.join(shard_dir, name), "r|") as tar:
+            for member in tar:
+                key, suffix = member.name.split(".", 1)
+                if key != current_key:
+                    if current_key is not None:
+                        yield assemble_sample(meta, arrays)
+                    current_key, meta, arrays = key, None, {}
+                data = tar.extractfile(member)
+                if suffix == "json":
+                    meta = json.loads(data.read().decode("utf-8"))
+                else:
+                    arrays[suffix] = np.load(io.BytesIO(data.read()), allow_pickle=False)
+        if current_key is not None:
+            yield assemble_sample(meta, arrays)
+
+
+if __name__ == "__main__":
+    groups_root = r"H:\MVS-Dataset\US3D-MVS\Test"
+    shard_dir = r"H:\MVS-Dataset\US3D-MVS\Test_shards"
+    export_shards(iter_group_folders(groups_root), shard_dir, max_shard_bytes=1 << 30)
+    # 也可以直接从清单导出：export_shards(iter_manifest_groups("manifest.jsonl"), shard_dir)